@@ -0,0 +1,53 @@
+'''
+Storage backends behind DbDriver
+
+A backend stores the paper nodes and their SIMILAR_TO relationships and runs the queries
+DbDriver needs. Papers are returned as dicts of the requested fields (see PAPER_FIELDS)
+'''
+import numpy as np
+
+# Properties returned for a paper when no field list is given
+PAPER_FIELDS = ["paper_id", "pdf", "author", "title", "year", "coord", "topic_prob", "layout"]
+
+# Vector properties of a paper, stored as packed float32 values
+VECTOR_FIELDS = ["coord", "topic_prob", "layout"]
+VECTOR_DTYPE = np.float32
+
+# Packed bytes of a vector
+def pack_vector(vector):
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+# Array view of packed vector bytes (no copy). Vectors stored as lists are converted
+def unpack_vector(data):
+    if isinstance(data, (bytes, bytearray)):
+        return np.frombuffer(data, dtype=VECTOR_DTYPE)
+    return np.asarray(data, dtype=VECTOR_DTYPE)
+
+# Requested paper fields (all if None), checked and with paper_id first. paper_id is always
+# included since it is used as the pagination cursor
+def paper_fields(fields):
+    if fields is None:
+        fields = PAPER_FIELDS
+    for field in fields:
+        if field not in PAPER_FIELDS:
+            raise ValueError("Unknown paper field: {}".format(field))
+    return ["paper_id"] + [field for field in fields if field != "paper_id"]
+
+# Open the backend for a database URI
+# bolt://, neo4j://: Neo4j server; embedded://<directory>: SQLite and memory-mapped files in
+# the directory (user and password are ignored); memory://: in-process stand-in (nothing is persisted).
+# The connection pool settings (see Neo4jBackend) only apply to Neo4j
+def open_backend(uri, user, password, pool_size=100, pool_timeout=60, pool_lifetime=3600):
+    scheme, path = uri.split("://", 1) if "://" in uri else ("", uri)
+
+    if scheme == "embedded":
+        from embedded_backend import EmbeddedBackend
+        return EmbeddedBackend(path)
+    if scheme == "memory":
+        from memory_backend import MemoryBackend
+        return MemoryBackend()
+    if scheme in ("bolt", "bolt+s", "bolt+ssc", "neo4j", "neo4j+s", "neo4j+ssc"):
+        from neo4j_backend import Neo4jBackend
+        return Neo4jBackend(uri, user, password, pool_size, pool_timeout, pool_lifetime)
+
+    raise ValueError("Database URI not supported: {}".format(uri))
@@ -0,0 +1,291 @@
+'''
+Driver-level benchmark of the DbDriver build and query methods
+
+A synthetic text corpus (model stage) is used to time build_db with model training,
+build_knn_graph, update_db and string queries. Then, for every scale, synthetic papers with
+clustered LSI vectors are loaded into a fresh database to time the other build and query
+methods, the queries first against the database and then against the in-process topic index
+and neighbour graph. Reports p50/p95/p99 latencies and throughput per scenario and writes them as JSON.
+
+Runs against the in-process stand-in backend (memory://) by default, so no Neo4j server is
+needed; pass --db-uri bolt://... to benchmark a live database instead (it is wiped).
+
+    python benchmark.py --scales 1000,10000,100000 --output results.json
+    python benchmark.py --scales 1000 --baseline results.json
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from db_driver import DbDriver
+
+SYLLABLES = [c + v for c in "bcdfghklmnprstvz" for v in "aeiou"]
+
+# Number of synthetic papers generated at once
+CHUNK_SIZE = 10000
+
+###### SYNTHETIC DATA ######
+
+# count distinct pronounceable words (they survive gensim's preprocessing)
+def synthetic_words(count, rng):
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(SYLLABLES, rng.integers(3, 5))))
+    return sorted(words)
+
+# Rows for DbDriver.insert_nodes: n papers numbered from first_id, with LSI coordinates drawn
+# around sqrt(n) cluster centres, Dirichlet topic probabilities and the first two coordinates
+# as layout. Generated CHUNK_SIZE rows at a time
+def synthetic_papers(n, num_lsi, num_lda, seed=0, first_id=0, vocabulary=None):
+    rng = np.random.default_rng(seed)
+    vocabulary = vocabulary or synthetic_words(2000, rng)
+    names = [word.capitalize() for word in synthetic_words(500, rng)]
+    centres = rng.normal(size=(max(1, int(np.sqrt(n))), num_lsi))
+
+    for start in range(0, n, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, n - start)
+        coords = (centres[rng.integers(0, len(centres), size)] + 0.3 * rng.normal(size=(size, num_lsi))).astype(np.float32)
+        topic_probs = rng.dirichlet(np.full(num_lda, 0.1), size).astype(np.float32)
+        titles = rng.choice(vocabulary, (size, 6))
+        authors = rng.choice(names, (size, 2))
+
+        for i in range(size):
+            paper_id = first_id + start + i
+            yield {"paper_id": paper_id, "pdf": "synthetic/{}.pdf".format(paper_id),
+                   "author": " ".join(authors[i]), "title": " ".join(titles[i]).capitalize(),
+                   "year": str(1987 + paper_id % 35), "coord": coords[i],
+                   "topic_prob": topic_probs[i], "layout": coords[i, :2]}
+
+# Write n synthetic papers numbered from first_id as empty PDFs (pdf_path/<year>/<name>.pdf)
+# and their text (text_path/<name>.txt). Each text mixes a few of num_topics topics, each topic
+# drawing words from its own slice of the vocabulary
+def synthetic_corpus(pdf_path, text_path, n, vocabulary, num_topics=10, words_per_paper=300, seed=0, first_id=0):
+    rng = np.random.default_rng(seed + first_id)
+    topics = np.array_split(np.array(vocabulary), num_topics)
+    os.makedirs(text_path, exist_ok=True)
+
+    for paper_id in range(first_id, first_id + n):
+        mixture = rng.dirichlet(np.full(num_topics, 0.2))
+        counts = rng.multinomial(words_per_paper, mixture)
+        words = np.concatenate([rng.choice(topic, count) for topic, count in zip(topics, counts)])
+        rng.shuffle(words)
+
+        name = "Paper_{}_{}_{}".format(paper_id, *words[:2])
+        year_path = os.path.join(pdf_path, str(1987 + paper_id % 35))
+        os.makedirs(year_path, exist_ok=True)
+        open(os.path.join(year_path, name + ".pdf"), "wb").close()
+        with open(os.path.join(text_path, name + ".txt"), "w") as f:
+            f.write(" ".join(words))
+
+###### TIMING ######
+
+# Latency percentiles (ms) and throughput of a list of durations (s). items: number of
+# papers (or rows) processed per run, to also report items per second
+def summarize(times, items=None):
+    times = np.asarray(times, dtype=np.float64)
+    total = float(times.sum())
+    res = {"runs": len(times), "total_s": total,
+           "mean_ms": 1000 * float(times.mean()),
+           "p50_ms": 1000 * float(np.percentile(times, 50)),
+           "p95_ms": 1000 * float(np.percentile(times, 95)),
+           "p99_ms": 1000 * float(np.percentile(times, 99)),
+           "ops_per_s": len(times) / max(total, 1e-12)}
+    if items is not None:
+        res["items_per_s"] = items * len(times) / max(total, 1e-12)
+    return res
+
+# Time fn(*args) for each args in inputs
+def measure(fn, inputs):
+    times = []
+    for args in inputs:
+        t_init = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - t_init)
+    return times
+
+def report(results, name, times, items=None):
+    results[name] = summarize(times, items)
+    r = results[name]
+    print("{:<40} runs {:>6}  p50 {:>10.3f} ms  p95 {:>10.3f} ms  p99 {:>10.3f} ms  {:>12.1f} ops/s".format(
+        name, r["runs"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["ops_per_s"]), flush=True)
+
+###### SCENARIOS ######
+
+# Arguments of query_by_strings calls: the strings of the (string,) queries, size at a time
+def string_batches(queries, size):
+    strings = [string for string, in queries]
+    return [(strings[start:start + size],) for start in range(0, len(strings), size)]
+
+def make_driver(args, work_path):
+    return DbDriver(args.db_uri, args.user, args.password, args.neighbours, args.numLSI, args.numLDA,
+                    os.path.join(work_path, "pdf", ""), os.path.join(work_path, "text", ""),
+                    os.path.join(work_path, "model", ""), False, args.search_mode, args.nprobe,
+                    args.batch_size, args.writers, args.workers, "pca", args.cache_size, 300,
+                    "neo4j", args.knn_backend, args.knn_mode, False, False, args.train_chunksize, args.lda_alpha)
+
+# Train the model on a synthetic corpus and time the full build cycle, the incremental
+# update and string queries. Leaves the trained model in work_path/model
+def model_stage(args, work_path, vocabulary, rng):
+    results = {}
+    os.makedirs(os.path.join(work_path, "model"), exist_ok=True)
+    synthetic_corpus(os.path.join(work_path, "pdf"), os.path.join(work_path, "text"), args.corpus_size,
+                     vocabulary, args.numLDA, seed=args.seed)
+
+    db = make_driver(args, work_path)
+    destroy, build, knn = [], [], []
+    for _ in range(args.build_runs):
+        destroy += measure(db.destroy_db, [()])
+        build += measure(db.build_db, [(True, True, False)])
+        knn += measure(db.build_knn_graph, [()])
+    report(results, "destroy_db", destroy)
+    report(results, "build_db", build, args.corpus_size)
+    report(results, "build_knn_graph", knn, args.corpus_size)
+
+    synthetic_corpus(os.path.join(work_path, "pdf"), os.path.join(work_path, "text"), args.update_size,
+                     vocabulary, args.numLDA, seed=args.seed, first_id=args.corpus_size)
+    report(results, "update_db", measure(db.update_db, [(True, False)]), args.update_size)
+
+    db.build_vector_index()
+    queries = [(" ".join(rng.choice(vocabulary, 3)),) for _ in range(args.queries)]
+    report(results, "query_by_string", measure(db.query_by_string, queries))
+    report(results, "query_by_strings", measure(db.query_by_strings, string_batches(queries, args.strings_per_batch)),
+           args.strings_per_batch)
+
+    db.close()
+    return results
+
+# Load n synthetic papers in a fresh database and time the remaining build and query methods
+def scale_stage(args, work_path, n, vocabulary, rng):
+    results = {}
+    db = make_driver(args, work_path)
+    db.ml_model.load()
+    db.destroy_db()
+
+    rows = list(synthetic_papers(n, args.numLSI, args.numLDA, args.seed, vocabulary=vocabulary))
+    report(results, "insert_nodes", measure(lambda: db.write_batches(rows, db.insert_nodes), [()]), n)
+    report(results, "create_indexes", measure(db.create_indexes, [()]), n)
+    report(results, "build_knn_graph", measure(db.build_knn_graph, [()]), n)
+    report(results, "build_vector_index", measure(db.build_vector_index, [()]), n)
+    report(results, "build_text_index", measure(db.build_text_index, [()]), n)
+
+    sample = [rows[i] for i in rng.integers(0, n, args.queries)]
+    for text_index in ("neo4j", "ngram"):
+        db.text_index = text_index
+        for mode in ("exact", "related"):
+            report(results, "query_by_author/{}/{}".format(mode, text_index),
+                   measure(db.query_by_author, [(row["author"], mode) for row in sample]))
+            report(results, "query_by_title/{}/{}".format(mode, text_index),
+                   measure(db.query_by_title, [(row["title"], mode) for row in sample]))
+        report(results, "query_by_title/prefix/{}".format(text_index),
+               measure(db.query_by_title, [(row["title"].split()[0], "exact", "prefix") for row in sample]))
+
+    for mode in ("exact", "related"):
+        report(results, "query_by_paper_id/" + mode, measure(db.query_by_paper_id, [(row["paper_id"], mode) for row in sample]))
+        report(results, "query_by_paper_id/{}/page".format(mode),
+               measure(db.query_by_paper_id, [(row["paper_id"], mode, ["paper_id", "title"], None, 10) for row in sample]))
+
+    report(results, "query_by_coord", measure(db.query_by_coord, [(row["coord"],) for row in sample]))
+    queries = [(" ".join(rng.choice(vocabulary, 3)),) for _ in sample]
+    report(results, "query_by_string", measure(db.query_by_string, queries))
+    report(results, "query_by_strings", measure(db.query_by_strings, string_batches(queries, args.strings_per_batch)),
+           args.strings_per_batch)
+    topics = [(int(topic_idx),) for topic_idx in rng.integers(0, args.numLDA, args.queries)]
+    report(results, "query_by_topic_index", measure(db.query_by_topic_index, topics))
+
+    # Same queries answered from the in-process topic index and neighbour graph
+    report(results, "build_topic_index", measure(db.build_topic_index, [()]), n)
+    report(results, "query_by_topic_index/index", measure(db.query_by_topic_index, topics))
+    report(results, "build_neighbour_graph", measure(db.build_neighbour_graph, [()]), n)
+    report(results, "query_by_author/related/graph", measure(db.query_by_author, [(row["author"], "related") for row in sample]))
+    report(results, "query_by_title/related/graph", measure(db.query_by_title, [(row["title"], "related") for row in sample]))
+    for hops in (1, 2):
+        report(results, "query_by_paper_id/related/graph/hops{}".format(hops),
+               measure(db.query_by_paper_id, [(row["paper_id"], "related", None, None, None, hops) for row in sample]))
+
+    # Single-paper writes last, the new papers have no neighbours
+    new_rows = synthetic_papers(args.queries, args.numLSI, args.numLDA, args.seed + 1, first_id=n, vocabulary=vocabulary)
+    report(results, "insert_node", measure(db.insert_node, [(row["paper_id"], row["pdf"], row["author"], row["title"],
+                                                              row["year"], row["coord"], row["topic_prob"]) for row in new_rows]))
+
+    db.destroy_db()
+    db.close()
+    return results
+
+# Print the scenarios whose p50 latency grew by more than threshold times against a baseline run
+def compare(results, baseline, threshold):
+    regressions = 0
+    for stage, scenarios in results["results"].items():
+        for name, r in scenarios.items():
+            base = baseline.get("results", {}).get(stage, {}).get(name)
+            if base is None:
+                continue
+            ratio = r["p50_ms"] / max(base["p50_ms"], 1e-9)
+            if ratio > threshold:
+                regressions += 1
+                print("REGRESSION {} {}: p50 {:.3f} ms -> {:.3f} ms ({:.2f}x)".format(stage, name, base["p50_ms"], r["p50_ms"], ratio))
+    print("\n{} regressions over {:.2f}x against the baseline\n".format(regressions, threshold))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DbDriver build and query methods on synthetic data")
+    parser.add_argument("--scales", help="Comma-separated numbers of synthetic papers (e.g. 1000,10000,100000,1000000)", default="1000,10000")
+    parser.add_argument("--corpus-size", help="Number of synthetic text files the model is trained on", default=1000, type=int)
+    parser.add_argument("--update-size", help="Number of papers added with update_db", default=100, type=int)
+    parser.add_argument("--build-runs", help="Number of destroy/build/KNN cycles timed on the corpus", default=3, type=int)
+    parser.add_argument("--queries", help="Number of calls timed per query scenario", default=1000, type=int)
+    parser.add_argument("--strings-per-batch", help="Number of topic strings per query_by_strings call", default=32, type=int)
+    parser.add_argument("--seed", help="Random seed of the synthetic data and queries", default=0, type=int)
+    parser.add_argument("-o", "--output", help="JSON file the results are written to", default="benchmark.json")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against", default=None)
+    parser.add_argument("--threshold", help="p50 slowdown ratio reported as a regression", default=1.2, type=float)
+    parser.add_argument("--work-dir", help="Directory for the synthetic corpus and model (default: temporary, removed afterwards)", default=None)
+    parser.add_argument("-r", "--db-uri", help="Database URI (memory:// for the in-process stand-in)", default="memory://")
+    parser.add_argument("-u", "--user", help="Database account username", default="neo4j")
+    parser.add_argument("-p", "--password", help="Database account password", default="capstone")
+    parser.add_argument("-k", "--neighbours", help="Number of neighbours in knn graph", default=25, type=int)
+    parser.add_argument("-lsi", "--numLSI", help="Number of LSI dimensions", default=10, type=int)
+    parser.add_argument("-lda", "--numLDA", help="Number of LDA topics", default=10, type=int)
+    parser.add_argument("-s", "--search-mode", help="Topic search index mode", default="exact", choices=["exact", "approx"])
+    parser.add_argument("--nprobe", help="Number of index lists scanned per topic query in approx search mode", default=8, type=int)
+    parser.add_argument("--batch-size", help="Number of papers written per database transaction", default=1000, type=int)
+    parser.add_argument("--writers", help="Number of concurrent database writer sessions", default=1, type=int)
+    parser.add_argument("-w", "--workers", help="Number of workers for document projection, LDA training and KNN (default: one per CPU core)", default=None, type=int)
+    parser.add_argument("--train-chunksize", help="Number of documents per LSI/LDA training chunk (default: gensim defaults)", default=None, type=int)
+    parser.add_argument("--lda-alpha", help="LDA prior; 'auto' is learned but trained in a single process", default="auto", choices=["auto", "symmetric", "asymmetric"])
+    parser.add_argument("--cache-size", help="Query cache size (default 0: time uncached queries)", default=0, type=int)
+    parser.add_argument("--knn-backend", help="KNN graph builder", default="native", choices=["gds", "native"])
+    parser.add_argument("--knn-mode", help="Exact or approximate neighbours for the native KNN graph builder", default="exact", choices=["exact", "approx"])
+    args = parser.parse_args()
+
+    work_path = args.work_dir or tempfile.mkdtemp(prefix="infera_benchmark_")
+    rng = np.random.default_rng(args.seed)
+    vocabulary = synthetic_words(2000, rng)
+    results = {"meta": {"args": vars(args), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                        "numpy": np.__version__, "platform": platform.platform(), "cpus": os.cpu_count()},
+               "results": {}}
+
+    try:
+        print("\n=== Model stage: {} papers ===\n".format(args.corpus_size))
+        results["results"]["model"] = model_stage(args, work_path, vocabulary, rng)
+        for n in [int(scale) for scale in args.scales.split(",")]:
+            print("\n=== Scale: {} papers ===\n".format(n))
+            results["results"][str(n)] = scale_stage(args, work_path, n, vocabulary, rng)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("\nResults written to {}\n".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f), args.threshold)
+
+if __name__ == "__main__":
+    main()
@@ -1,371 +1,631 @@
-from neo4j import GraphDatabase
+import functools
 from pathlib import Path
 import time
 import numpy as np
-import random
-from model import *
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+from backend import PAPER_FIELDS, VECTOR_DTYPE, open_backend
+from vector_index import VectorIndex
+from layout import global_layout
+from query_cache import QueryCache
+from text_index import NgramIndex
+from topic_index import TopicIndex
+from neighbour_graph import NeighbourGraph
+from knn import knn_graph, knn_recall
+from metrics import observe, timed
+
+# Decorator recording the duration of a DbDriver call in the driver histogram (also printed
+# in debug mode)
+def _timed(method):
+    @functools.wraps(method)
+    def timed_method(self, *args, **kwargs):
+        t_init = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            t_tot = time.perf_counter() - t_init
+            observe("driver", method.__name__, t_tot)
+            if self.debug_info:
+                print("(INFO): {} {:.3f} s elapsed".format(method.__name__, t_tot))
+    return timed_method
+
+# Number of queries scored against the vector index at once by query_by_strings (bounds the
+# score matrix to SEARCH_CHUNK x VectorIndex.block_size)
+SEARCH_CHUNK = 256
+
+# Hashable form of a field list for cache keys
+def _fields_key(fields):
+    return None if fields is None else tuple(fields)
 
 class DbDriver:
 
     # Connect to the DB
-    def __init__(self, uri, user, password, numK, numLSI, numLDA, pdf_path, text_path, model_path, debug_info):
-
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
-        self.graph_name = 'neuripsGraph' # Name of the GDS graph
+    def __init__(self, uri, user, password, numK, numLSI, numLDA, pdf_path, text_path, model_path, debug_info,
+                 search_mode="exact", nprobe=8, batch_size=1000, writers=1, workers=None,
+                 layout_method="tsne", cache_size=1024, cache_ttl=300, text_index="neo4j", knn_backend="gds",
+                 knn_mode="exact", knn_recall=False, fast_start=False, train_chunksize=None, lda_alpha="auto",
+                 pool_size=100, pool_timeout=60, pool_lifetime=3600):
+
+        # Paper storage (Neo4j, embedded or in-memory, see open_backend), with pool_size Neo4j
+        # connections waited for at most pool_timeout seconds and replaced after pool_lifetime seconds
+        self.backend = open_backend(uri, user, password, pool_size, pool_timeout, pool_lifetime)
         self.numK = numK # Number of neighbours for the KNN algorithm
         self.numLSI = numLSI # Number of LSI dimensions
         self.numLDA = numLDA # Number of LDA topics
         self.pdf_path = pdf_path # FS path to the PDF files (It will search for PDFs recursively starting here)
         self.text_path = text_path # FS path to the .txt files
         self.model_path = model_path # FS path to the model
-        self.debug_info = debug_info # Turn on/off debug messages
-        self.ml_model = SimilarityModel(self.text_path, self.model_path, self.numLSI, self.numLDA)
+        self.debug_info = debug_info # Print the duration of every build and query call
+        self.batch_size = batch_size # Number of rows written per UNWIND transaction
+        self.writers = writers # Number of concurrent writer sessions
+        self.workers = workers # Number of workers for parallel build steps, including LDA training (None: one per core)
+        self.train_chunksize = train_chunksize # Documents per LSI/LDA training chunk (None: gensim defaults)
+        self.lda_alpha = lda_alpha # LDA prior: 'auto' (learned, single-process training), 'symmetric' or 'asymmetric'
+        self.layout_method = layout_method # Method for the global 2D layout of the papers ('tsne' or 'pca')
+        self.fast_start = fast_start # Memory-map the saved model and load each part on first use
+        self._ml_model = None # See ml_model
+        self._topic_terms = None # See topic_terms
+        self.model_lock = Lock()
+        self.vector_index = VectorIndex(search_mode, nprobe=nprobe) # In-process index used for topic search
+        self.query_cache = QueryCache(cache_size, cache_ttl) # Cached query results, cleared when the graph or model changes
+        self.text_index = text_index # Author/title search backend: 'neo4j' (indexed properties) or 'ngram' (in-process)
+        self.text_indexes = {"author": NgramIndex(), "title": NgramIndex()}
+        self.topic_index = TopicIndex() # Papers ranked by probability for each LDA topic, for topic browsing
+        self.neighbour_graph = NeighbourGraph() # In-process KNN graph and paper table for related queries
+        self.knn_backend = knn_backend # KNN graph builder: 'gds' (gds.beta.knn in the DB) or 'native' (Python)
+        self.knn_mode = knn_mode # 'exact' or 'approx' neighbours for the native KNN builder
+        self.knn_recall = knn_recall # Report the recall of the native KNN graph against GDS
+
+    # Similarity model, created on first use (importing the model module imports gensim). In
+    # fast start mode, the saved model is loaded lazily with its arrays memory-mapped
+    @property
+    def ml_model(self):
+        with self.model_lock:
+            if self._ml_model is None:
+                from model import SimilarityModel
+                self._ml_model = SimilarityModel(self.text_path, self.model_path, self.numLSI, self.numLDA,
+                                                 self.workers, self.train_chunksize, self.lda_alpha)
+                if self.fast_start:
+                    self._ml_model.load(mmap="r", lazy=True)
+            return self._ml_model
+
+    # Top terms of each LDA topic, computed on first use
+    @property
+    def topic_terms(self):
+        if self._topic_terms is None:
+            self._topic_terms = self.ml_model.set_topic_terms()
+        return self._topic_terms
 
     # Close DB connection
     def close(self):
-        self.driver.close()
+        self.backend.close()
+
+    # Open database connections ahead of the first queries
+    def warm_up(self, connections):
+        self.backend.warm_up(connections)
+
+    # Connection pool counters of the backend (name -> value)
+    def pool_stats(self):
+        return self.backend.pool_stats()
+
+    # Context in which the queries of the calling thread share one database session, e.g. the
+    # queries of one request
+    def session(self):
+        return self.backend.session()
 
     # Build the DB
+    @_timed
     def build_db(self, train_model, create_db_nodes, convert_pdfs):
-        if self.debug_info:
-            t_init = time.perf_counter()
-
         print("\nBuilding model...\n")
 
         print("Inside db driver: {}".format(convert_pdfs))
         if convert_pdfs:
             print("Inside db driver: {}".format(convert_pdfs))
-            pdf_to_text(self.pdf_path, self.text_path)
+            from model import pdf_to_text
+            pdf_to_text(self.pdf_path, self.text_path, self.workers)
 
         if train_model:
             print("\nWill train new model...\n")
             self.ml_model.build()
+        elif self.fast_start:
+            print("\nWill load existing model on first use...\n")
         else:
             print("\nWill load existing model...\n")
             self.ml_model.load()
 
-        self.topic_terms = self.ml_model.set_topic_terms()
+        self._topic_terms = None
+
+        self.create_indexes()
 
         if create_db_nodes:
             print("\nBuilding database...\n")
 
-            i = 0
-            for path in Path(self.pdf_path).glob('*/*.pdf'):
-                paper_id = i
+            t_build = time.perf_counter()
+            paths = list(Path(self.pdf_path).glob('*/*.pdf'))
 
-                pdf = str(path)
-                year = pdf.split(self.pdf_path,1)[1].split("/")[0].split("\\")[0]
+            # Project every paper through LSI and LDA in parallel, chunked batches
+            coords, topic_probs = self.ml_model.document_map_batch([path.stem for path in paths], self.workers)
 
-                author = "Jane Doe " + str(i) # Placeholder
-                #print(path.stem)
-                coord_tuple = self.ml_model.document_map(path.stem)
-                title = path.stem.replace("_", " ")
+            # Global 2D layout used by the visualization route, computed once per build
+            layouts = global_layout(coords, self.layout_method).astype(VECTOR_DTYPE)
 
-                coord = [np.finfo(np.float64).eps] * self.numLSI
-                for coordinate in coord_tuple[0]: # Get LSI coordinates
-                    coord[coordinate[0]] = np.float64(coordinate[1])
+            rows = self._paper_rows(paths, 0, coords, topic_probs, layouts)
+            i = len(rows)
 
-                topic_prob = [0] * self.numLDA
-                for coordinate in coord_tuple[1]: # Get LDA probabilities
-                    topic_prob[coordinate[0]] = np.float64(coordinate[1])
-                self.insert_node(paper_id, pdf, author, title,year, coord, topic_prob)
-                i+=1
+            self.write_batches(rows, self.insert_nodes)
+            t_build = time.perf_counter() - t_build
 
-            print("\nDatabase successfully built! Number of papers: {}\n".format(i))
+            print("\nDatabase successfully built! Number of papers: {} ({:.1f} rows/s)\n".format(i, i / max(t_build, 1e-9)))
 
-        if self.debug_info:
-            t_final = time.perf_counter()
-            t_tot = t_final-t_init
-            print("(INFO): {:.3f} s elapsed".format(t_tot))
-            return t_tot
+        # Papers or model changed, cached results are stale
+        self.query_cache.invalidate()
+
+    # Add the papers that are not in the DB yet without rebuilding it. With update_model, the
+    # dictionary and models are first updated online with the new papers instead of retrained.
+    # Only the new papers are inserted, and SIMILAR_TO edges are only recomputed for the new papers
+    # and for the existing papers that get one of them as a nearer neighbour
+    @_timed
+    def update_db(self, update_model, convert_pdfs):
+        if convert_pdfs:
+            from model import pdf_to_text
+            pdf_to_text(self.pdf_path, self.text_path, self.workers)
+
+        self.ml_model.load()
+        self.create_indexes()
+
+        existing = self.backend.get_pdfs()
+
+        paths = [path for path in Path(self.pdf_path).glob('*/*.pdf') if str(path) not in existing]
+        print("\nFound {} new papers\n".format(len(paths)))
+
+        if paths:
+            if update_model:
+                print("\nUpdating model with new papers...\n")
+                self.ml_model.update([path.stem for path in paths])
+            self._topic_terms = None
+
+            coords, topic_probs = self.ml_model.document_map_batch([path.stem for path in paths], self.workers)
+            first_id = max(existing.values(), default=-1) + 1
+            new_ids = np.arange(first_id, first_id + len(paths))
+
+            # Exact neighbours over all papers, existing and new
+            paper_ids, all_coords = self.backend.get_coords()
+            knn_index = VectorIndex("exact")
+            all_coords = np.asarray(all_coords, dtype=VECTOR_DTYPE).reshape(-1, coords.shape[1])
+            knn_index.build(np.concatenate((np.asarray(paper_ids, dtype=np.int64), new_ids)), np.concatenate((all_coords, coords)))
+            new_neighbours, new_scores = self._neighbours(knn_index, new_ids, coords)
+
+            # New papers are placed at the mean layout position of their neighbours
+            known_layouts = self.backend.get_layouts()
+            layouts = np.zeros((len(paths), 2), dtype=VECTOR_DTYPE)
+            for i, neighbours in enumerate(new_neighbours):
+                points = [known_layouts[n] for n in neighbours if n in known_layouts]
+                if points:
+                    layouts[i] = np.mean(points, axis=0)
+
+            self.write_batches(self._paper_rows(paths, first_id, coords, topic_probs, layouts), self.insert_nodes)
+
+            # Existing papers whose current K-th neighbour is further than one of the new papers
+            kth_scores = self.backend.get_kth_scores()
+            new_index = VectorIndex("exact")
+            new_index.build(new_ids, coords)
+            displaced = []
+            displaced_neighbours = []
+            displaced_scores = []
+            if paper_ids:
+                nearest_new, nearest_scores = new_index.search(all_coords, self.numK)
+                rows = [i for i, paper_id in enumerate(paper_ids)
+                        if kth_scores.get(paper_id, (None, 0))[1] < self.numK or nearest_scores[i, 0] > kth_scores[paper_id][0]]
+                displaced = [paper_ids[i] for i in rows]
+
+                # Merge their current neighbours with their nearest new papers
+                current = self.backend.get_neighbours(displaced)
+                for i, paper_id in zip(rows, displaced):
+                    candidates = current.get(paper_id, []) + list(zip(nearest_new[i].tolist(), nearest_scores[i].tolist()))
+                    candidates = sorted(candidates, key=lambda candidate: -candidate[1])[:self.numK]
+                    displaced_neighbours.append([target for target, _ in candidates])
+                    displaced_scores.append([score for _, score in candidates])
+
+            self.write_batches(displaced, self.delete_edges)
+            edges = chain(self._edge_rows(new_ids, new_neighbours, new_scores),
+                          self._edge_rows(displaced, displaced_neighbours, displaced_scores))
+            self.write_batches(edges, self.insert_edges)
+
+            print("\nAdded {} papers, updated the neighbours of {} existing papers\n".format(len(paths), len(displaced)))
+
+        self.query_cache.invalidate()
+        if len(self.neighbour_graph) > 0:
+            self.build_neighbour_graph()
+
+    # Rows for insert_nodes for the PDFs in paths, numbered from first_id. Vectors are float32
+    # array rows, stored as such by the backend
+    def _paper_rows(self, paths, first_id, coords, topic_probs, layouts):
+        rows = []
+        for i, path in enumerate(paths):
+            paper_id = first_id + i
+
+            pdf = str(path)
+            year = pdf.split(self.pdf_path,1)[1].split("/")[0].split("\\")[0]
+
+            author = "Jane Doe " + str(paper_id) # Placeholder
+            title = path.stem.replace("_", " ")
+
+            rows.append({"paper_id": paper_id, "pdf": pdf, "author": author, "title": title, \
+                         "year": year, "coord": coords[i], "topic_prob": topic_probs[i], "layout": layouts[i]})
+        return rows
+
+    # K nearest papers (by cosine similarity) of the given papers, excluding the papers themselves
+    def _neighbours(self, index, paper_ids, coords):
+        if len(paper_ids) == 0:
+            return [], []
+
+        ids, scores = index.search(coords, self.numK + 1)
+        neighbours = []
+        neighbour_scores = []
+        for paper_id, row_ids, row_scores in zip(paper_ids, ids, scores):
+            keep = row_ids != paper_id
+            neighbours.append(row_ids[keep][:self.numK].tolist())
+            neighbour_scores.append(row_scores[keep][:self.numK].tolist())
+        return neighbours, neighbour_scores
+
+    # Rows for insert_edges from each paper to its neighbours (negative ids mark missing neighbours)
+    @staticmethod
+    def _edge_rows(paper_ids, neighbours, scores):
+        return ({"source": int(paper_id), "target": int(target), "score": float(score)}
+                for paper_id, targets, target_scores in zip(paper_ids, neighbours, scores)
+                for target, score in zip(targets, target_scores) if target >= 0)
 
     # Destroy the DB and GDS KNN graph (if any)
+    @_timed
     def destroy_db(self):
-        if self.debug_info:
-            t_init = time.perf_counter()
-
         print("\nTearing down database...\n")
 
-        with self.driver.session() as session:
-            session.write_transaction(self._destroy_gds_graph, self.graph_name)
-            session.write_transaction(self._destroy_db)
+        self.backend.destroy()
 
-        if self.debug_info:
-            t_final = time.perf_counter()
+        self.query_cache.invalidate()
+        self.neighbour_graph = NeighbourGraph()
 
         print("\nDatabase successfully removed!\n")
 
-        if self.debug_info:
-            t_tot = t_final-t_init
-            print("(INFO): {:.3f} s elapsed".format(t_tot))
-            return t_tot
+    # Create the DB indexes used by queries (if they do not exist yet) and fill the
+    # lower-cased author/title properties of papers inserted without them
+    def create_indexes(self):
+        self.backend.create_indexes()
+
+    # Build the in-process n-gram indexes over author names and titles
+    @_timed
+    def build_text_index(self):
+        paper_ids, authors, titles = self.backend.get_text()
+
+        self.text_indexes["author"].build(paper_ids, authors)
+        self.text_indexes["title"].build(paper_ids, titles)
+        self.query_cache.invalidate()
+        print("\nText index built. Number of papers: {}\n".format(len(paper_ids)))
 
     # Insert a node (paper) in the graph database
     def insert_node(self, paper_id, pdf, author, title, year, coord, topic_prob):
-        with self.driver.session() as session:
-            session.write_transaction(self._insert_node, paper_id, pdf, author, title, year, coord, topic_prob)
+        self.backend.insert_node(paper_id, pdf, author, title, year, coord, topic_prob)
+
+        self.query_cache.invalidate()
+
+    # Insert many nodes (papers) in the graph database in a single transaction
+    # rows: list of dicts with the same properties as insert_node
+    def insert_nodes(self, rows):
+        self.backend.insert_nodes(rows)
+
+    # Create SIMILAR_TO relationships. rows: list of dicts with source and target paper_id and score
+    def insert_edges(self, rows):
+        self.backend.insert_edges(rows)
+
+    # Delete the outgoing SIMILAR_TO relationships of the given papers
+    def delete_edges(self, paper_ids):
+        self.backend.delete_edges(paper_ids)
+
+    # Write rows (any iterable) in batches of self.batch_size using write_fn(batch), with up to
+    # self.writers batches in flight at once. Returns the number of rows written
+    def write_batches(self, rows, write_fn):
+        rows = iter(rows)
+        batches = iter(lambda: list(islice(rows, self.batch_size)), [])
+        count = 0
+
+        if self.writers <= 1:
+            for batch in batches:
+                write_fn(batch)
+                count += len(batch)
+            return count
+
+        with ThreadPoolExecutor(max_workers=self.writers) as pool:
+            pending = set()
+            for batch in batches:
+                if len(pending) >= self.writers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(pool.submit(write_fn, batch))
+                count += len(batch)
+            for future in pending:
+                future.result()
+
+        return count
 
     # Run the KNN algorithm in the DB nodes
+    @_timed
     def build_knn_graph(self):
-        if self.debug_info:
-            t_init = time.perf_counter()
-
-        with self.driver.session() as session:
-            # Destroy GDS graph if it exists
-            session.write_transaction(self._destroy_gds_graph, self.graph_name)
-            # Create GDS graph
-            session.write_transaction(self._create_gds_graph, self.graph_name)
-            print("\nCreated GDS graph\n")
-            session.write_transaction(self._run_knn, self.graph_name, self.numK)
-            print("\nKNN graph built\n")
-
-        if self.debug_info:
-            t_final = time.perf_counter()
-            t_tot = t_final-t_init
-            print("(INFO): {:.3f} s elapsed".format(t_tot))
-            return t_tot
+        if self.knn_backend == "native":
+            self._build_native_knn_graph()
+        else:
+            self.backend.run_knn(self.numK)
 
-    # Query the DB by author
-    # mode: 'exact' - get exact matches; 'related' - get related results
-    def query_by_author(self, author, mode):
-        if self.debug_info:
-            t_init = time.perf_counter()
+        self.query_cache.invalidate()
+        if len(self.neighbour_graph) > 0:
+            self.build_neighbour_graph()
 
-        with self.driver.session() as session:
-            res = session.read_transaction(self._query_by_author, author, mode)
+    # Compute the KNN graph in Python (blocked, multi-threaded matrix multiplies) and replace
+    # the SIMILAR_TO relationships with it. Does not need the GDS plugin
+    def _build_native_knn_graph(self):
+        t_start = time.perf_counter()
+        paper_ids, coords = self.backend.get_coords()
 
-        if self.debug_info:
-            t_final = time.perf_counter()
-            t_tot = t_final-t_init
-            print("\n(INFO): {:.3f} s elapsed".format(t_tot))
-            return (res, t_tot)
+        neighbours, scores = knn_graph(paper_ids, coords, self.numK, self.knn_mode, workers=self.workers)
+        t_knn = time.perf_counter() - t_start
+        print("\nKNN graph computed ({} mode) in {:.3f} s\n".format(self.knn_mode, t_knn))
 
-        return res
+        if self.knn_recall:
+            self._print_knn_recall(paper_ids, neighbours)
 
-    # Query the DB by title
-    # mode: 'exact' - get exact matches; 'related' - get related results
-    def query_by_title(self, title, mode):
-        if self.debug_info:
-            t_init = time.perf_counter()
+        t_write = time.perf_counter()
+        self.write_batches(paper_ids, self.delete_edges)
+        edges = self.write_batches(self._edge_rows(paper_ids, neighbours, scores), self.insert_edges)
+        t_write = time.perf_counter() - t_write
+        print("\nKNN graph written: {} relationships in {:.3f} s ({:.1f} rows/s)\n".format(edges, t_write, edges / max(t_write, 1e-9)))
 
-        with self.driver.session() as session:
-            res = session.read_transaction(self._query_by_title, title, mode)
+    # Compare a KNN graph with the one GDS computes (streamed, not written). Needs the GDS plugin
+    def _print_knn_recall(self, paper_ids, neighbours):
+        t_gds = time.perf_counter()
+        reference = self.backend.stream_knn(self.numK)
+        t_gds = time.perf_counter() - t_gds
 
-        if self.debug_info:
-            t_final = time.perf_counter()
-            t_tot = t_final-t_init
-            print("(INFO): {:.3f} s elapsed".format(t_tot))
-            return (res, t_tot)
+        found = {paper_id: row.tolist() for paper_id, row in zip(paper_ids, neighbours)}
+        print("\nKNN recall against GDS: {:.4f} (GDS took {:.3f} s)\n".format(knn_recall(found, reference), t_gds))
 
-        return res
+    # Query the DB by author
+    # mode: 'exact' - get exact matches; 'related' - get related results
+    # match: 'contains' - author contains the string; 'prefix' - author starts with the string
+    # fields: paper properties to return (None: all); cursor, limit, hops: see query_by_paper_id
+    @_timed
+    def query_by_author(self, author, mode, match="contains", fields=None, cursor=None, limit=None, hops=1):
+        key = QueryCache.key("author", author, (mode, match, _fields_key(fields), cursor, limit, hops))
+        return self._cached_query(key, self._search_text, "author", author, mode, match, fields, cursor, limit, hops)
 
-    # Query the DB by string
-    def query_by_string(self, string):
+    # Query the DB by title
+    # mode: 'exact' - get exact matches; 'related' - get related results
+    # match: 'contains' - title contains the string; 'prefix' - title starts with the string
+    # fields: paper properties to return (None: all); cursor, limit, hops: see query_by_paper_id
+    @_timed
+    def query_by_title(self, title, mode, match="contains", fields=None, cursor=None, limit=None, hops=1):
+        key = QueryCache.key("title", title, (mode, match, _fields_key(fields), cursor, limit, hops))
+        return self._cached_query(key, self._search_text, "title", title, mode, match, fields, cursor, limit, hops)
+
+    # Build the in-process vector index from the coordinates stored in the DB
+    @_timed
+    def build_vector_index(self):
+        paper_ids, coords = self.backend.get_coords()
+
+        self.vector_index.build(paper_ids, coords)
+        self.query_cache.invalidate()
+        print("\nVector index built ({} mode). Number of papers: {}\n".format(self.vector_index.mode, len(self.vector_index)))
+
+    # Build the per-topic ranked paper lists from the topic probabilities stored in the DB
+    @_timed
+    def build_topic_index(self):
+        paper_ids, topic_probs = self.backend.get_topic_probs()
+
+        self.topic_index.build(paper_ids, topic_probs, self.numLDA)
+        self.query_cache.invalidate()
+        print("\nTopic index built. Number of papers: {}, topics: {}\n".format(len(self.topic_index), self.topic_index.num_topics))
+
+    # Load the KNN graph and the paper properties from the DB into the in-process neighbour
+    # graph, which then answers related queries. Refreshed by build_knn_graph and update_db
+    @_timed
+    def build_neighbour_graph(self):
+        paper_ids, _, _ = self.backend.get_text()
+        neighbour_graph = NeighbourGraph()
+        neighbour_graph.build(self.backend.query_by_paper_ids(paper_ids), self.backend.get_neighbours(paper_ids))
+
+        self.neighbour_graph = neighbour_graph
+        self.query_cache.invalidate()
+        print("\nNeighbour graph built. Number of papers: {}, relationships: {}\n".format(len(neighbour_graph), neighbour_graph.num_edges))
 
+    # Query the DB by string
+    # fields: paper properties to return (None: all)
+    @_timed
+    def query_by_string(self, string, fields=None):
+        return self._cached_query(QueryCache.key("topic", string, _fields_key(fields)), self._search_string, string, fields)
+
+    # Query the DB by many topic strings at once. The strings not cached are projected together,
+    # scored against the vector index SEARCH_CHUNK at a time, and the papers found for all of
+    # them are fetched with one DB query. Returns one list of papers per string, in order
+    # fields: paper properties to return (None: all)
+    @_timed
+    def query_by_strings(self, strings, fields=None):
+        keys = [QueryCache.key("topic", string, _fields_key(fields)) for string in strings]
+        results = {}
+        for key in set(keys):
+            res = self.query_cache.get(key)
+            if res is not None:
+                results[key] = res
+
+        missing = {key: string for key, string in zip(keys, strings) if key not in results}
+        if missing:
+            coords = np.zeros((len(missing), self.numLSI), dtype=np.float32)
+            lsi_coords = self.ml_model.strings_lookup(list(missing.values()))
+            dims = min(lsi_coords.shape[1], self.numLSI)
+            coords[:, :dims] = lsi_coords[:, :dims]
+
+            if len(self.vector_index) > 0:
+                with timed("stage", "vector_search"):
+                    ids = [self.vector_index.search(coords[start:start + SEARCH_CHUNK], self.numK)[0]
+                           for start in range(0, len(coords), SEARCH_CHUNK)]
+                ids = np.concatenate(ids).tolist()
+                found = {paper_id for row in ids for paper_id in row if paper_id >= 0}
+                papers = {paper["paper_id"]: paper for paper in self._db(self.backend.query_by_paper_ids, sorted(found), fields)}
+                found = [[papers[paper_id] for paper_id in row if paper_id in papers] for row in ids]
+            else:
+                found = [self._db(self.backend.query_by_coord, coord.tolist(), self.numK, fields) for coord in coords]
+
+            for key, res in zip(missing, found):
+                results[key] = res
+                self.query_cache.put(key, [dict(p) for p in res])
+
+        # Papers are copied so that callers can modify them
+        return [[dict(p) for p in results[key]] for key in keys]
+
+    # Query the DB by coordinates
+    # fields: paper properties to return (None: all)
+    @_timed
+    def query_by_coord(self, coord, fields=None):
+        return self._search_coord(coord, fields)
+
+    def _search_string(self, string, fields):
         # Transform string into coordinate vector
         topic_coord = self.ml_model.string_lookup(string)
         string_coord = [0] * self.numLSI
-        dim = 0
-        print(len(topic_coord))
-        print(len(string_coord))
-        for coord_tuple in topic_coord:
-            string_coord[dim] = coord_tuple[1]
-            dim+=1
-
-        if self.debug_info:
-            t_init = time.perf_counter()
-
-        with self.driver.session() as session:
-            res = session.read_transaction(self._query_by_coord, string_coord, self.numK)
-
-        if self.debug_info:
-            t_final = time.perf_counter()
-            t_tot = t_final-t_init
-            print("(INFO): {:.3f} s elapsed".format(t_tot))
-            return (res, t_tot)
-
-        return res
-
-    # Query the DB by model topic index
-    def query_by_topic_index(self, topic_idx):
-        if self.debug_info:
-            t_init = time.perf_counter()
-
-        with self.driver.session() as session:
-            res = session.read_transaction(self._query_by_topic_index, topic_idx, self.numK)
-
-        if self.debug_info:
-            t_final = time.perf_counter()
-            t_tot = t_final-t_init
-            print("(INFO): {:.3f} s elapsed".format(t_tot))
-            return (res, t_tot)
-
-        return res
-
-    # Query the DB by paper_id. paper_id: int
-    def query_by_paper_id(self, paper_id, mode):
-        if self.debug_info:
-            t_init = time.perf_counter()
-
-        with self.driver.session() as session:
-            res = session.read_transaction(self._query_by_paper_id, paper_id, self.numK, mode)
-
-        if self.debug_info:
-            t_final = time.perf_counter()
-            t_tot = t_final-t_init
-            print("(INFO): {:.3f} s elapsed".format(t_tot))
-            return (res, t_tot)
-
-        return res
-
-    ###### STATIC METHODS TO RUN CYPHER QUERIES ######
-
-    # Insert a node in the DB given its properties
-    @staticmethod
-    def _insert_node(tx, paper_id, pdf, author, title, year, coord, topic_prob):
-        result = tx.run("MERGE (p:Paper {paper_id:$paper_id, pdf:$pdf, author:$author, title:$title, year:$year}) \
-                        SET p.coord = $coord \
-                        SET p.topic_prob = $topic_prob", \
-                        paper_id=paper_id, pdf=pdf, author=author, title=title, year=year, coord=coord, topic_prob=topic_prob)
-
-    # Create the GDS graph in the catalog using native projection
-    @staticmethod
-    def _create_gds_graph(tx, name):
-        result = tx.run("CALL gds.graph.create($name, {Paper: {label: 'Paper', \
-                        properties: { \
-                            topic_prob: { \
-                                property: 'topic_prob' \
-                            }, \
-                            coord: { \
-                                property: 'coord' \
-                            } \
-                        }}}, '*') ", name=name)
-
-    # Destroy GDS graph
-    @staticmethod
-    def _destroy_gds_graph(tx, name):
-        result = tx.run("CALL gds.graph.drop($name, false) ", name=name)
-
-    # Runs the KNN algo in the graph database based on cosine similarity
-    @staticmethod
-    def _run_knn(tx, name, K):
-        result = tx.run("CALL gds.beta.knn.write($name,{writeRelationshipType: 'SIMILAR_TO', \
-                        writeProperty: 'score', topK: $K, sampleRate: 1, deltaThreshold: 0, \
-                        maxIterations: 1000, randomSeed: 0, nodeWeightProperty: 'coord'}) \
-                        YIELD nodesCompared, relationshipsWritten ", name=name, K=K)
-
-    # Query DB by author. Return matching papers and their nearest neighbours
-    @staticmethod
-    def _query_by_author(tx, author, mode):
-        if mode == "exact": # Return only exact matches
-            result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE toLower(p1.author) \
-                        CONTAINS toLower($author) RETURN collect(DISTINCT p1) AS P ", author=author)
-        elif mode == "related": # Return only related papers
-            result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE toLower(p1.author) \
-                        CONTAINS toLower($author) RETURN collect(DISTINCT p2) AS P ", author=author)
-        else:
-            print("Query mode not supported!")
-            return
-
-        p_list = []
-
-        for r in result:
-            for p in r["P"]:
-                prop = p._properties
-                p_list.append({"paper_id": prop["paper_id"], "pdf": prop["pdf"], \
-                                "author": prop["author"], "title": prop["title"], "year": prop["year"], \
-                                "coord": prop["coord"], "topic_prob": prop["topic_prob"]})
-
-        return p_list
-
-    # Query DB by paper title. Return matching papers and their nearest neighbours
-    @staticmethod
-    def _query_by_title(tx, title, mode):
-        if mode == "exact": # Return only exact matches
-            result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE toLower(p1.title) \
-                        CONTAINS toLower($title) RETURN collect(DISTINCT p1) AS P ", title=title)
-        elif mode == "related":
-            result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE toLower(p1.title) \
-                        CONTAINS toLower($title) RETURN collect(DISTINCT p2) AS P ", title=title)
-        else:
-            print("Query mode not supported!")
-            return
-
-        p_list = []
-
-        for r in result:
-            for p in r["P"]:
-                prop = p._properties
-                p_list.append({"paper_id": prop["paper_id"], "pdf": prop["pdf"], \
-                                "author": prop["author"], "title": prop["title"], "year": prop["year"], \
-                                "coord": prop["coord"], "topic_prob": prop["topic_prob"]})
-
-
-        return p_list
-
-    # Query DB by coordinates. Return the nearest neighbours to the given coordinate
-    @staticmethod
-    def _query_by_coord(tx, coord, K):
-        result = tx.run("MATCH (p:Paper) RETURN p, gds.alpha.similarity.cosine($coord, \
-                        p.coord) AS sim ORDER BY sim DESC LIMIT $K ", coord=coord, K=K)
-
-        p_list = []
-
-        for r in result:
-            p = r["p"]
-            prop = p._properties
-            p_list.append({"paper_id": prop["paper_id"], "pdf": prop["pdf"], \
-                            "author": prop["author"], "title": prop["title"],  "year": prop["year"],\
-                            "coord": prop["coord"], "topic_prob": prop["topic_prob"]})
-
-        return p_list
-
-    # Query DB by model topic index. Return the K papers that have highest probability
-    # for the topic
-    @staticmethod
-    def _query_by_topic_index(tx, topic_idx, K):
-        result = tx.run("MATCH (p:Paper) RETURN p, p.topic_prob[$topic_idx] AS prob \
-                        ORDER BY prob DESC LIMIT $K ", topic_idx=topic_idx, K=K)
-
-        p_list = []
-
-        for r in result:
-            p = r["p"]
-            prop = p._properties
-            p_list.append({"paper_id": prop["paper_id"], "pdf": prop["pdf"], \
-                            "author": prop["author"], "title": prop["title"],  "year": prop["year"],\
-                            "coord": prop["coord"], "topic_prob": prop["topic_prob"]})
-
-        return p_list
-
-    # Query DB by paper id
-    @staticmethod
-    def _query_by_paper_id(tx, paper_id, K, mode):
-        if mode == "exact": # Return only exact matches
-            result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE p1.paper_id \
-                        = $paper_id RETURN collect(DISTINCT p1) AS P ", paper_id=paper_id)
+        for dim, value in topic_coord:
+            string_coord[dim] = value
+
+        return self._search_coord(string_coord, fields)
+
+    # Nearest papers to the coordinates. Uses the in-process vector index when it has been built,
+    # otherwise falls back to scoring every paper in the DB
+    def _search_coord(self, coord, fields=None):
+        if len(self.vector_index) > 0:
+            with timed("stage", "vector_search"):
+                ids, scores = self.vector_index.search(coord, self.numK)
+            paper_ids = [int(paper_id) for paper_id in ids[0] if paper_id >= 0]
+            return self._db(self.backend.query_by_paper_ids, paper_ids, fields)
+
+        return self._db(self.backend.query_by_coord, coord, self.numK, fields)
+
+    # Papers whose author or title (field) matches the text, or their related papers. Uses the
+    # in-process n-gram index when selected and built, otherwise the DB property indexes, and
+    # the neighbour graph (when built) for related papers
+    def _search_text(self, field, text, mode, match, fields, cursor, limit, hops=1):
+        in_process = len(self.neighbour_graph) > 0 or hops > 1
+        if self.text_index == "ngram" and len(self.text_indexes[field]) > 0:
+            with timed("stage", "text_search"):
+                paper_ids = sorted(self.text_indexes[field].search(text, match == "prefix"))
+            if mode == "related" and not in_process:
+                return self._db(self.backend.query_related_by_paper_ids, paper_ids, fields, cursor, limit)
+            return self._matches_or_related(paper_ids, mode, fields, cursor, limit, hops)
+
+        query = self.backend.query_by_author if field == "author" else self.backend.query_by_title
+        if mode == "related" and in_process:
+            matches = [paper["paper_id"] for paper in self._db(query, text, "exact", match, ["paper_id"])]
+            return self._matches_or_related(matches, mode, fields, cursor, limit, hops)
+        return self._db(query, text, mode, match, fields, cursor, limit)
+
+    # The matching papers (mode 'exact') or the papers related to them in 1 to hops steps
+    # (mode 'related'), paged by paper_id
+    def _matches_or_related(self, matches, mode, fields, cursor, limit, hops):
+        if mode == "exact":
+            paper_ids = sorted(matches)
         elif mode == "related":
-            result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE p1.paper_id \
-                        = $paper_id RETURN collect(DISTINCT p2) AS P ", paper_id=paper_id)
+            paper_ids = self._related_ids(matches, hops)
         else:
             print("Query mode not supported!")
             return
 
-        p_list = []
-
-        for r in result:
-            for p in r["P"]:
-                prop = p._properties
-                p_list.append({"paper_id": prop["paper_id"], "pdf": prop["pdf"], \
-                            "author": prop["author"], "title": prop["title"],  "year": prop["year"],\
-                            "coord": prop["coord"], "topic_prob": prop["topic_prob"]})
+        paper_ids = [paper_id for paper_id in paper_ids if cursor is None or paper_id > cursor][:limit]
+        return self._papers(paper_ids, fields)
+
+    # Sorted ids of the papers reached from the given papers in 1 to hops steps (without the given
+    # papers if hops > 1, see NeighbourGraph.expand), expanded in the neighbour graph when built,
+    # otherwise one DB query per step
+    def _related_ids(self, paper_ids, hops):
+        if len(self.neighbour_graph) > 0:
+            with timed("stage", "graph_search"):
+                return self.neighbour_graph.expand(paper_ids, hops)
+
+        reached = set()
+        frontier = list(paper_ids)
+        for _ in range(hops):
+            if not frontier:
+                break
+            neighbours = self._db(self.backend.get_neighbours, frontier)
+            frontier = {target for edges in neighbours.values() for target, _ in edges} - reached
+            reached |= frontier
+            frontier = sorted(frontier)
+
+        if hops > 1:
+            reached -= set(paper_ids)
+        return sorted(reached)
+
+    # Papers by id, from the neighbour graph's paper table when built, otherwise from the DB
+    def _papers(self, paper_ids, fields):
+        if len(self.neighbour_graph) > 0:
+            with timed("stage", "hydration"):
+                return self.neighbour_graph.papers(paper_ids, fields)
+        return self._db(self.backend.query_by_paper_ids, paper_ids, fields)
+
+    # Run a backend query, timed as the db_query stage
+    def _db(self, query, *args):
+        with timed("stage", "db_query"):
+            return query(*args)
+
+    # Return the cached result for key, or run query(*args) and cache its result. Papers are
+    # copied in and out of the cache so that callers can modify them
+    def _cached_query(self, key, query, *args):
+        res = self.query_cache.get(key)
+        if res is not None:
+            return [dict(p) for p in res]
+
+        res = query(*args)
+        if res is not None:
+            self.query_cache.put(key, [dict(p) for p in res])
+        return res
 
-        return p_list
+    # Query the DB by model topic index. Papers are ordered by decreasing probability for the topic
+    # fields: paper properties to return (None: all)
+    # cursor: number of papers of the ranking already returned (None: start from the first)
+    # limit: maximum number of papers returned (None: numK)
+    @_timed
+    def query_by_topic_index(self, topic_idx, fields=None, cursor=None, limit=None):
+        start = cursor or 0
+        limit = self.numK if limit is None else limit
+
+        # Page of the precomputed ranking, otherwise sorted in the DB
+        if self.topic_index.num_topics > 0:
+            with timed("stage", "topic_search"):
+                paper_ids, _ = self.topic_index.page(topic_idx, start, limit)
+            return self._db(self.backend.query_by_paper_ids, paper_ids, fields)
+
+        key = QueryCache.key("topic_index", topic_idx, (_fields_key(fields), start, limit))
+        res = self._cached_query(key, self._db, self.backend.query_by_topic_index, topic_idx, start + limit, fields)
+        return res[start:]
 
-    # Remove all nodes and connections in the DB
-    @staticmethod
-    def _destroy_db(tx):
-        result = tx.run("MATCH(p:Paper) DETACH DELETE p")
+    # Query the DB by paper_id. paper_id: int
+    # fields: paper properties to return (None: all)
+    # cursor: only return papers with a paper_id greater than this (the last paper_id of the previous page)
+    # limit: maximum number of papers returned (None: all). Paged results are ordered by paper_id
+    # hops: in 'related' mode, also return the papers related to the related papers, up to hops steps away
+    # Answered in-process when the neighbour graph is built
+    @_timed
+    def query_by_paper_id(self, paper_id, mode, fields=None, cursor=None, limit=None, hops=1):
+        if len(self.neighbour_graph) > 0:
+            # As in the DB queries, only papers with neighbours match
+            matches = [paper_id] if self.neighbour_graph.has_neighbours(paper_id) else []
+            return self._matches_or_related(matches, mode, fields, cursor, limit, hops)
+
+        key = QueryCache.key("id", paper_id, (mode, _fields_key(fields), cursor, limit, hops))
+        if hops > 1:
+            return self._cached_query(key, self._search_id, paper_id, mode, fields, cursor, limit, hops)
+        return self._cached_query(key, self._db, self.backend.query_by_paper_id, paper_id, self.numK, mode, fields, cursor, limit)
+
+    # query_by_paper_id with more than one hop, without the neighbour graph
+    def _search_id(self, paper_id, mode, fields, cursor, limit, hops):
+        matches = [paper_id] if self._db(self.backend.get_neighbours, [paper_id]) else []
+        return self._matches_or_related(matches, mode, fields, cursor, limit, hops)
 
 if __name__ == "__main__":
 
@@ -403,56 +663,4 @@ if __name__ == "__main__":
 
     db_driver.close()
 
-    # PERFORMANCE TESTS
-    # -----------------
-
-    # tear_down_times = [0] * 5
-    # build_times = [0] * 5
-
-    # for i in range(5):
-    #     tear_down_times[i] = db_driver.destroy_db()
-
-    #     build_db_t = db_driver.build_db()
-    #     build_knn_t = db_driver.build_knn_graph()
-    #     build_times[i] = build_db_t + build_knn_t
-
-    # e_author_times = [0] * 1000
-    # r_author_times = [0] * 1000
-
-    # for i in range(1000):
-
-    #     p1_list, e_author_times[i] = db_driver.query_by_author("Jane Doe " + str(i), "exact")
-    #     p2_list, r_author_times[i] = db_driver.query_by_author("Jane Doe " + str(i), "related")
-
-    # e_title_times = [0] * 1000
-    # r_title_times = [0] * 1000
-
-    # for i in range(1000):
-
-    #     p1_list, e_title_times[i] = db_driver.query_by_title("Paper " + str(i), "exact")
-    #     p2_list, r_title_times[i] = db_driver.query_by_title("Paper " + str(i), "related")
-
-
-    # coord_times = [0] * 1000
-
-    # for i in range(1000):
-
-    #     p_list, coord_times[i] = db_driver.query_by_coord([random.random(), random.random(), random.random()])
-
-    # connection_times = []
-
-    # for i in range(100):
-    #     connection_t1 = time.perf_counter()
-    #     db_driver = DbDriver("bolt://localhost:7687", "neo4j", "capstone", 100, r"/bigdata/NeuripsArchive/NeurIPS/", True)
-    #     connection_t2 = time.perf_counter()
-    #     connection_times.append(connection_t2 - connection_t1)
-
-
-    # print("\nTear Down Time: {:.5f} +- {:.5f} s\n".format(np.mean(tear_down_times), np.std(tear_down_times)))
-    # print("\nBuild Time: {:.5f} +- {:.5f} s\n".format(np.mean(build_times), np.std(build_times)))
-    # print("\nExact Author Time: {:.8f} +- {:.8f} s\n".format(np.mean(e_author_times), np.std(e_author_times)))
-    # print("\nRelated Author Time: {:.8f} +- {:.8f} s\n".format(np.mean(r_author_times), np.std(r_author_times)))
-    # print("\nExact Title Time: {:.8f} +- {:.8f} s\n".format(np.mean(e_title_times), np.std(e_title_times)))
-    # print("\nRelated Title Time: {:.8f} +- {:.8f} s\n".format(np.mean(r_title_times), np.std(r_title_times)))
-    # print("\nCoordinate Time: {:.8f} +- {:.8f} s\n".format(np.mean(coord_times), np.std(coord_times)))
-    # print("\nConnection Time: {:.5f} +- {:.5f} s\n".format(np.mean(connection_times), np.std(connection_times)))
+    # Timing of the build and query methods: see benchmark.py
@@ -0,0 +1,421 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import nullcontext
+import numpy as np
+from backend import VECTOR_DTYPE, VECTOR_FIELDS, paper_fields
+from knn import knn_graph
+from metrics import timed
+from vector_index import normalize, top_k
+
+# Paper metadata, and the neighbours of each paper as packed arrays (int64 paper ids, float32 scores)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (paper_id INTEGER PRIMARY KEY, row INTEGER NOT NULL, pdf TEXT, author TEXT,
+                                   title TEXT, year TEXT, author_lower TEXT, title_lower TEXT);
+CREATE INDEX IF NOT EXISTS papers_pdf ON papers (pdf);
+CREATE TABLE IF NOT EXISTS neighbours (paper_id INTEGER PRIMARY KEY, targets BLOB NOT NULL, scores BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS dims (field TEXT PRIMARY KEY, dim INTEGER NOT NULL);
+"""
+
+# JSON array of paper ids, expanded in queries with json_each (no limit on the number of ids)
+def _ids_json(paper_ids):
+    return json.dumps([int(paper_id) for paper_id in paper_ids])
+
+class EmbeddedBackend:
+    '''
+
+    Single-node storage without a database server, in a directory:
+    - papers.sqlite: paper metadata and each paper's neighbours as packed adjacency arrays
+    - coord.f32, topic_prob.f32, layout.f32: packed float32 vectors, one row per paper, read
+      through memory-mapped NumPy arrays
+
+    Queries run in-process. Reads use one SQLite connection per thread, writes are serialized.
+
+    '''
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.lock = threading.RLock() # Serializes writes
+        self.local = threading.local()
+        self.connections = []
+        self.version = 0 # Incremented on every paper write, invalidates the cached arrays below
+        self._cache = {} # name -> (version, value)
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+        self.local = threading.local()
+
+    # SQLite connections are opened per thread on first use, there is no pool to warm up
+    def warm_up(self, connections):
+        pass
+
+    def pool_stats(self):
+        return {"connections": len(self.connections)}
+
+    # Each thread already reuses its connection
+    def session(self):
+        return nullcontext()
+
+    def destroy(self):
+        with self.lock:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM papers")
+                conn.execute("DELETE FROM neighbours")
+                conn.execute("DELETE FROM dims")
+            # Removed rather than truncated, memory maps still in use stay valid
+            for field in VECTOR_FIELDS:
+                if os.path.exists(self._vector_file(field)):
+                    os.remove(self._vector_file(field))
+            self.version += 1
+
+    # Case-insensitive author/title lookups use indexes on the lower-cased properties
+    def create_indexes(self):
+        with self.lock:
+            conn = self._conn()
+            with conn:
+                conn.execute("CREATE INDEX IF NOT EXISTS papers_author ON papers (author_lower)")
+                conn.execute("CREATE INDEX IF NOT EXISTS papers_title ON papers (title_lower)")
+                conn.execute("UPDATE papers SET author_lower = lower(author), title_lower = lower(title) \
+                              WHERE author_lower IS NULL OR title_lower IS NULL")
+
+    def insert_node(self, paper_id, pdf, author, title, year, coord, topic_prob):
+        self.insert_nodes([{"paper_id": paper_id, "pdf": pdf, "author": author, "title": title, "year": year,
+                            "coord": coord, "topic_prob": topic_prob}])
+
+    # rows: list of dicts with the paper properties. Papers already stored are overwritten in
+    # place, vectors not given (e.g. layout) are kept
+    def insert_nodes(self, rows):
+        if not rows:
+            return
+
+        with self.lock:
+            conn = self._conn()
+            found = dict(conn.execute("SELECT paper_id, row FROM papers WHERE paper_id IN (SELECT value FROM json_each(?))",
+                                      (_ids_json(row["paper_id"] for row in rows),)))
+            next_row = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM papers").fetchone()[0]
+
+            paper_rows = []
+            for row in rows:
+                if row["paper_id"] not in found:
+                    found[row["paper_id"]] = next_row
+                    next_row += 1
+                paper_rows.append(found[row["paper_id"]])
+
+            for field in VECTOR_FIELDS:
+                self._write_vectors(field, paper_rows, [row.get(field) for row in rows], next_row)
+
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 [(int(row["paper_id"]), paper_row, row["pdf"], row["author"], row["title"], row["year"],
+                                   (row["author"] or "").lower(), (row["title"] or "").lower())
+                                  for row, paper_row in zip(rows, paper_rows)])
+            self.version += 1
+
+    # rows: list of dicts with source and target paper_id and score. Added to the current
+    # neighbours of each source; edges to or from unknown papers are skipped
+    def insert_edges(self, rows):
+        if not rows:
+            return
+
+        with self.lock:
+            conn = self._conn()
+            ids = _ids_json({row["source"] for row in rows} | {row["target"] for row in rows})
+            known = {paper_id for (paper_id,) in conn.execute(
+                "SELECT paper_id FROM papers WHERE paper_id IN (SELECT value FROM json_each(?))", (ids,))}
+
+            added = {}
+            for row in rows:
+                if row["source"] in known and row["target"] in known:
+                    added.setdefault(row["source"], {})[row["target"]] = row["score"]
+
+            current = self._neighbours(conn, list(added))
+            for source, targets in added.items():
+                merged = dict(current.get(source, []))
+                merged.update(targets)
+                added[source] = merged
+
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO neighbours VALUES (?, ?, ?)",
+                                 [self._pack(source, list(targets), list(targets.values())) for source, targets in added.items()])
+
+    def delete_edges(self, paper_ids):
+        with self.lock:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM neighbours WHERE paper_id IN (SELECT value FROM json_each(?))", (_ids_json(paper_ids),))
+
+    # Replace the neighbours with the exact K nearest neighbours of every paper
+    def run_knn(self, K):
+        paper_ids, coords = self.get_coords()
+        neighbours, scores = knn_graph(paper_ids, coords, K)
+
+        with self.lock:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM neighbours")
+                conn.executemany("INSERT INTO neighbours VALUES (?, ?, ?)",
+                                 (self._pack(paper_id, targets[targets >= 0], target_scores[targets >= 0])
+                                  for paper_id, targets, target_scores in zip(paper_ids, neighbours, scores)))
+        print("\nKNN graph built\n")
+
+    def stream_knn(self, K):
+        paper_ids, coords = self.get_coords()
+        neighbours, _ = knn_graph(paper_ids, coords, K)
+        return {paper_id: [target for target in targets if target >= 0] for paper_id, targets in zip(paper_ids, neighbours.tolist())}
+
+    def get_text(self):
+        rows = self._conn().execute("SELECT paper_id, author, title FROM papers").fetchall()
+        return [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]
+
+    def get_pdfs(self):
+        return dict(self._conn().execute("SELECT pdf, paper_id FROM papers"))
+
+    def get_layouts(self):
+        paper_ids, rows = self._ids_by_row()
+        layouts = self._vectors("layout")
+        if len(layouts) == 0:
+            return {}
+        layouts = self._take(layouts, rows)
+        keep = ~np.isnan(layouts).any(axis=1)
+        return dict(zip(paper_ids[keep].tolist(), layouts[keep].tolist()))
+
+    def get_kth_scores(self):
+        kth_scores = {}
+        for paper_id, targets, scores in self._conn().execute("SELECT paper_id, targets, scores FROM neighbours"):
+            scores = np.frombuffer(scores, dtype=np.float32)
+            if len(scores) > 0:
+                kth_scores[paper_id] = (float(scores.min()), len(scores))
+        return kth_scores
+
+    def get_neighbours(self, paper_ids):
+        return {paper_id: neighbours for paper_id, neighbours in self._neighbours(self._conn(), paper_ids).items() if neighbours}
+
+    # Paper ids and coordinates (a float32 array, one row per paper, read-only)
+    def get_coords(self):
+        paper_ids, rows = self._ids_by_row()
+        coords = self._vectors("coord")
+        return paper_ids.tolist(), self._take(coords, rows) if len(coords) > 0 else np.zeros((0, 0), dtype=VECTOR_DTYPE)
+
+    # Paper ids and LDA topic probabilities (a float32 array, one row per paper, read-only)
+    def get_topic_probs(self):
+        paper_ids, rows = self._ids_by_row()
+        topic_probs = self._vectors("topic_prob")
+        return paper_ids.tolist(), self._take(topic_probs, rows) if len(topic_probs) > 0 else np.zeros((0, 0), dtype=VECTOR_DTYPE)
+
+    def query_by_author(self, author, mode, match, fields=None, cursor=None, limit=None):
+        return self._query_by_text("author_lower", author, mode, match, fields, cursor, limit)
+
+    def query_by_title(self, title, mode, match, fields=None, cursor=None, limit=None):
+        return self._query_by_text("title_lower", title, mode, match, fields, cursor, limit)
+
+    def query_by_coord(self, coord, K, fields=None):
+        paper_ids, matrix = self._cached("normalized_coords", lambda: (self._ids_by_row()[0], normalize(self.get_coords()[1])))
+        if len(paper_ids) == 0:
+            return []
+        rows, _ = top_k(normalize(np.atleast_2d(coord)), matrix, min(K, len(paper_ids)), 65536)
+        return self._project(paper_ids[rows[0]].tolist(), fields)
+
+    # Papers in the same order as the ids
+    def query_by_paper_ids(self, paper_ids, fields=None):
+        return self._project(paper_ids, fields)
+
+    # Nearest neighbours of the given papers
+    def query_related_by_paper_ids(self, paper_ids, fields=None, cursor=None, limit=None):
+        related = {target for neighbours in self._neighbours(self._conn(), paper_ids).values() for target, _ in neighbours}
+        return self._project(self._page(related, cursor, limit), fields)
+
+    # The K papers with the highest probability for the topic
+    def query_by_topic_index(self, topic_idx, K, fields=None):
+        paper_ids, rows = self._ids_by_row()
+        topic_probs = self._vectors("topic_prob")
+        if len(paper_ids) == 0 or not -topic_probs.shape[1] <= topic_idx < topic_probs.shape[1]:
+            return []
+
+        probs = np.nan_to_num(topic_probs[rows, topic_idx], nan=-np.inf)
+        K = min(K, len(probs))
+        best = np.argpartition(-probs, K - 1)[:K]
+        best = best[np.argsort(-probs[best], kind="stable")]
+        return self._project(paper_ids[best].tolist(), fields)
+
+    def query_by_paper_id(self, paper_id, K, mode, fields=None, cursor=None, limit=None):
+        # As in the Cypher queries, only papers with neighbours match
+        found = self._conn().execute("SELECT 1 FROM neighbours WHERE paper_id = ? AND length(targets) > 0", (paper_id,)).fetchone()
+        return self._matches_or_related([paper_id] if found else [], mode, fields, cursor, limit)
+
+    # Papers whose lower-cased property contains (or starts with) the text, or their neighbours
+    def _query_by_text(self, prop, text, mode, match, fields, cursor, limit):
+        text = text.lower()
+        if match == "prefix": # Range scan on the index
+            condition = "p.{0} >= ? AND p.{0} < ?".format(prop)
+            args = (text, text + "\U0010ffff")
+        else:
+            condition = "instr(p.{}, ?) > 0".format(prop)
+            args = (text,)
+
+        matches = [paper_id for (paper_id,) in self._conn().execute(
+            "SELECT p.paper_id FROM papers p JOIN neighbours n ON n.paper_id = p.paper_id \
+             WHERE length(n.targets) > 0 AND " + condition, args)]
+        return self._matches_or_related(matches, mode, fields, cursor, limit)
+
+    def _matches_or_related(self, matches, mode, fields, cursor, limit):
+        if mode == "exact": # Return only exact matches
+            return self._project(self._page(matches, cursor, limit), fields)
+        elif mode == "related": # Return only related papers
+            return self.query_related_by_paper_ids(matches, fields, cursor, limit)
+        else:
+            print("Query mode not supported!")
+            return
+
+    # Page through paper ids in paper_id order: ids after cursor (if not None), at most limit (if not None)
+    @staticmethod
+    def _page(paper_ids, cursor, limit):
+        paper_ids = sorted(paper_id for paper_id in paper_ids if cursor is None or paper_id > cursor)
+        return paper_ids if limit is None else paper_ids[:limit]
+
+    # The requested fields of the papers, as dicts in the same order as the ids (unknown ids skipped)
+    def _project(self, paper_ids, fields):
+        with timed("stage", "hydration"):
+            return self._fetch(paper_ids, fields)
+
+    def _fetch(self, paper_ids, fields):
+        fields = paper_fields(fields)
+        columns = [field for field in fields if field not in VECTOR_FIELDS] # Starts with paper_id
+        found = {}
+        if paper_ids:
+            for r in self._conn().execute("SELECT row, " + ", ".join(columns) + " FROM papers \
+                                           WHERE paper_id IN (SELECT value FROM json_each(?))", (_ids_json(paper_ids),)):
+                found[r[1]] = r
+
+        found = [found[paper_id] for paper_id in paper_ids if paper_id in found]
+        papers = [dict(zip(columns, r[1:])) for r in found]
+
+        # Vectors of all the papers gathered at once from the memory maps
+        rows = np.array([r[0] for r in found], dtype=np.int64)
+        for field in fields:
+            if field in VECTOR_FIELDS:
+                for paper, value in zip(papers, self._vector_values(field, rows)):
+                    paper[field] = value
+
+        return [{field: paper[field] for field in fields} for paper in papers]
+
+    # Stored vectors of a field at the given rows as lists, None where never set
+    def _vector_values(self, field, rows):
+        values = np.asarray(self._vectors(field))
+        if len(rows) == 0 or values.shape[1] == 0:
+            return [None] * len(rows)
+
+        stored = rows < len(values)
+        block = np.full((len(rows), values.shape[1]), np.nan, dtype=VECTOR_DTYPE)
+        block[stored] = values[rows[stored]]
+        unset = np.isnan(block).all(axis=1)
+        return [None if missing else value for missing, value in zip(unset.tolist(), block.tolist())]
+
+    # Current neighbours of the papers, as a dict paper_id -> list of (neighbour paper_id, score)
+    @staticmethod
+    def _neighbours(conn, paper_ids):
+        neighbours = {}
+        for paper_id, targets, scores in conn.execute(
+                "SELECT paper_id, targets, scores FROM neighbours WHERE paper_id IN (SELECT value FROM json_each(?))",
+                (_ids_json(paper_ids),)):
+            neighbours[paper_id] = list(zip(np.frombuffer(targets, dtype=np.int64).tolist(),
+                                            np.frombuffer(scores, dtype=np.float32).tolist()))
+        return neighbours
+
+    # Row of the neighbours table for a paper
+    @staticmethod
+    def _pack(paper_id, targets, scores):
+        return (int(paper_id), np.asarray(targets, dtype=np.int64).tobytes(), np.asarray(scores, dtype=np.float32).tobytes())
+
+    # Paper ids and their vector rows, ordered by row
+    def _ids_by_row(self):
+        def load():
+            rows = np.array(self._conn().execute("SELECT paper_id, row FROM papers ORDER BY row").fetchall(), dtype=np.int64).reshape(-1, 2)
+            return rows[:, 0], rows[:, 1]
+        return self._cached("ids_by_row", load)
+
+    # Memory-mapped (read-only) vectors of a field, one row per paper row
+    def _vectors(self, field):
+        def load():
+            dim = self._dim(field)
+            path = self._vector_file(field)
+            if dim is None or not os.path.exists(path) or os.path.getsize(path) == 0:
+                return np.zeros((0, dim or 0), dtype=VECTOR_DTYPE)
+            return np.memmap(path, dtype=VECTOR_DTYPE, mode="r").reshape(-1, dim)
+        return self._cached("vectors_" + field, load)
+
+    # values[rows]: a view of the memory map instead of a copy when the rows are the first rows in order
+    @staticmethod
+    def _take(values, rows):
+        if len(rows) <= len(values) and np.array_equal(rows, np.arange(len(rows))):
+            return values[:len(rows)]
+        return values[rows]
+
+    # Write the vectors of a field at the given rows (NaN for None values, other rows are kept).
+    # num_rows: number of paper rows after this write
+    def _write_vectors(self, field, rows, values, num_rows):
+        given = [i for i, value in enumerate(values) if value is not None]
+        dim = self._dim(field)
+        if dim is None:
+            if not given:
+                return
+            dim = len(values[given[0]])
+            with self._conn() as conn:
+                conn.execute("INSERT INTO dims VALUES (?, ?)", (field, dim))
+
+        path = self._vector_file(field)
+        itemsize = np.dtype(VECTOR_DTYPE).itemsize * dim
+        with open(path, "ab") as f: # Grow the file to num_rows rows, new rows are NaN
+            size = f.tell()
+            missing = num_rows - size // itemsize
+            if missing > 0:
+                f.write(np.full((missing, dim), np.nan, dtype=VECTOR_DTYPE).tobytes())
+
+        if not given:
+            return
+        vectors = np.array([values[i] for i in given], dtype=VECTOR_DTYPE)
+        if vectors.shape[1] != dim:
+            raise ValueError("Expected {} values for {}, got {}".format(dim, field, vectors.shape[1]))
+
+        rows = np.asarray(rows)[given]
+        with open(path, "r+b") as f:
+            if np.all(np.diff(rows) == 1): # Consecutive rows (e.g. new papers) are written at once
+                f.seek(int(rows[0]) * itemsize)
+                f.write(vectors.tobytes())
+                return
+            for row, vector in zip(rows, vectors):
+                f.seek(int(row) * itemsize)
+                f.write(vector.tobytes())
+
+    def _dim(self, field):
+        r = self._conn().execute("SELECT dim FROM dims WHERE field = ?", (field,)).fetchone()
+        return None if r is None else r[0]
+
+    def _vector_file(self, field):
+        return os.path.join(self.path, field + ".f32")
+
+    # Value of load(), reused until the papers change
+    def _cached(self, name, load):
+        version = self.version
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        value = load()
+        self._cache[name] = (version, value)
+        return value
+
+    # SQLite connection of the calling thread
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.path, "papers.sqlite"), check_same_thread=False)
+            self.local.conn = conn
+            self.connections.append(conn)
+        return conn
@@ -0,0 +1,75 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from vector_index import VectorIndex, normalize, top_k
+
+# Memory budget of one thread in exact mode: a block of query rows is scored against
+# KNN_COLUMNS papers at a time, which takes 16 bytes per score (float32 score and int64
+# argpartition index, with headroom), so a block has KNN_BLOCK_BYTES / (16 * KNN_COLUMNS) rows
+KNN_BLOCK_BYTES = 32 * 2**20
+KNN_COLUMNS = 16384
+
+# Default number of threads (each holds KNN_BLOCK_BYTES of scores)
+KNN_MAX_WORKERS = 4
+
+def knn_graph(ids, vectors, K, mode="exact", block_size=None, workers=None, nprobe=16):
+    '''
+
+    K nearest neighbours (by cosine similarity) of every vector, excluding itself.
+
+    The rows are split in blocks of block_size queries (None: sized from KNN_BLOCK_BYTES), each
+    block is scored against the (normalized) matrix KNN_COLUMNS papers at a time with matrix
+    multiplies and blocks run in parallel threads (NumPy releases the GIL during the multiply;
+    None: one per core, at most KNN_MAX_WORKERS). In 'approx' mode each block is searched in an
+    IVF index instead, scanning nprobe lists per query.
+
+    Returns two (len(ids) x K) arrays: neighbour ids (-1 where a row has fewer than K neighbours)
+    and float32 scores
+
+    '''
+    ids = np.asarray(ids, dtype=np.int64)
+    matrix = normalize(vectors)
+    K = min(K, max(len(ids) - 1, 0))
+
+    neighbours = np.full((len(ids), K), -1, dtype=np.int64)
+    scores = np.full((len(ids), K), -np.inf, dtype=np.float32)
+    if K == 0:
+        return neighbours, scores
+
+    columns = min(KNN_COLUMNS, len(ids))
+    if block_size is None:
+        block_size = max(1, min(2048, KNN_BLOCK_BYTES // (16 * columns)))
+
+    if mode == "approx":
+        index = VectorIndex("approx", nprobe=nprobe)
+        index.build(ids, matrix)
+    elif mode != "exact":
+        raise ValueError("KNN mode not supported: {}".format(mode))
+
+    def run_block(start):
+        block = matrix[start:start + block_size]
+        block_ids = ids[start:start + block_size]
+        if mode == "approx":
+            found, found_scores = index.search(block, K + 1)
+        else:
+            rows, found_scores = top_k(block, matrix, K + 1, columns)
+            found = ids[rows]
+
+        # Drop each paper from its own neighbour list (move it last, keep the first K)
+        order = np.argsort(found == block_ids[:, None], axis=1, kind="stable")[:, :K]
+        neighbours[start:start + len(block)] = np.take_along_axis(found, order, axis=1)
+        scores[start:start + len(block)] = np.take_along_axis(found_scores, order, axis=1)
+
+    with ThreadPoolExecutor(max_workers=workers or min(os.cpu_count() or 1, KNN_MAX_WORKERS)) as pool:
+        list(pool.map(run_block, range(0, len(ids), block_size)))
+
+    return neighbours, scores
+
+# Fraction of the reference neighbours also found in neighbours. Both are dicts paper_id -> neighbour ids
+def knn_recall(neighbours, reference):
+    found = 0
+    total = 0
+    for paper_id, expected in reference.items():
+        found += len(set(expected) & set(neighbours.get(paper_id, [])))
+        total += len(expected)
+    return found / total if total else 1.0
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+
+# 2D layout of the paper coordinates. method: 'tsne' or 'pca'
+def global_layout(coords, method="tsne", seed=0):
+    coords = np.asarray(coords, dtype=np.float64)
+
+    if method == "pca" or len(coords) < 3:
+        return pca_layout(coords)
+    if method == "tsne":
+        return tsne_layout(coords, seed)
+
+    raise ValueError("Layout method not supported: {}".format(method))
+
+# Project the coordinates onto their first two principal components
+def pca_layout(coords):
+    coords = np.asarray(coords, dtype=np.float64)
+    layout = np.zeros((len(coords), 2))
+    if len(coords) == 0:
+        return layout
+
+    centered = coords - coords.mean(axis=0)
+    _, _, vt = np.linalg.svd(centered, full_matrices=False)
+    components = min(2, vt.shape[0])
+    layout[:, :components] = centered @ vt[:components].T
+    return layout
+
+# t-SNE embedding of the coordinates (sklearn is only imported when needed)
+def tsne_layout(coords, seed=0):
+    from sklearn.manifold import TSNE
+
+    coords = np.asarray(coords, dtype=np.float64)
+    perplexity = min(30.0, max(1.0, (len(coords) - 1) / 3))
+    return TSNE(n_components=2, perplexity=perplexity, init="pca", random_state=seed).fit_transform(coords)
+
+class LayoutCache:
+    '''
+
+    LRU cache of per-paper local layouts. Holds at most `maxsize` layouts, the least recently
+    used one is evicted first.
+
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.layouts = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.layouts)
+
+    def get(self, key):
+        with self.lock:
+            layout = self.layouts.get(key)
+            if layout is not None:
+                self.layouts.move_to_end(key)
+            return layout
+
+    def put(self, key, layout):
+        with self.lock:
+            self.layouts[key] = layout
+            self.layouts.move_to_end(key)
+            while len(self.layouts) > self.maxsize:
+                self.layouts.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.layouts.clear()
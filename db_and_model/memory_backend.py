@@ -0,0 +1,203 @@
+from contextlib import nullcontext
+from threading import RLock
+import numpy as np
+from backend import VECTOR_DTYPE, VECTOR_FIELDS, paper_fields
+from knn import knn_graph
+from metrics import timed
+from vector_index import normalize, top_k
+
+class MemoryBackend:
+    '''
+
+    In-process stand-in for the Neo4j backend, with the same queries and results, for running
+    DbDriver (e.g. in benchmarks) without a database server. Papers are kept in a dict (vectors
+    as float32 arrays) and SIMILAR_TO relationships in per-paper dicts; nothing is persisted.
+
+    '''
+    def __init__(self):
+        self.papers = {} # paper_id -> dict of paper properties
+        self.edges = {} # paper_id -> {neighbour paper_id: score}
+        self.lock = RLock()
+        self._matrix = None # (paper ids, normalized coords) for query_by_coord, rebuilt after writes
+
+    def close(self):
+        pass
+
+    # No connections: nothing to warm up, no pool, no sessions
+    def warm_up(self, connections):
+        pass
+
+    def pool_stats(self):
+        return {}
+
+    def session(self):
+        return nullcontext()
+
+    def destroy(self):
+        with self.lock:
+            self.papers = {}
+            self.edges = {}
+            self._matrix = None
+
+    # Author/title matching scans the lower-cased properties, there are no indexes to create
+    def create_indexes(self):
+        with self.lock:
+            for paper in self.papers.values():
+                paper["author_lower"] = (paper["author"] or "").lower()
+                paper["title_lower"] = (paper["title"] or "").lower()
+
+    def insert_node(self, paper_id, pdf, author, title, year, coord, topic_prob):
+        layout = self.papers.get(paper_id, {}).get("layout")
+        self.insert_nodes([{"paper_id": paper_id, "pdf": pdf, "author": author, "title": title, "year": year,
+                            "coord": coord, "topic_prob": topic_prob, "layout": layout}])
+
+    # rows: list of dicts with the paper properties
+    def insert_nodes(self, rows):
+        with self.lock:
+            for row in rows:
+                paper = {field: row.get(field) for field in paper_fields(None)}
+                for field in VECTOR_FIELDS:
+                    if paper[field] is not None:
+                        paper[field] = np.array(paper[field], dtype=VECTOR_DTYPE)
+                paper["author_lower"] = (paper["author"] or "").lower()
+                paper["title_lower"] = (paper["title"] or "").lower()
+                self.papers[paper["paper_id"]] = paper
+            self._matrix = None
+
+    # rows: list of dicts with source and target paper_id and score
+    def insert_edges(self, rows):
+        with self.lock:
+            for row in rows:
+                if row["source"] in self.papers and row["target"] in self.papers:
+                    self.edges.setdefault(row["source"], {})[row["target"]] = row["score"]
+
+    def delete_edges(self, paper_ids):
+        with self.lock:
+            for paper_id in paper_ids:
+                self.edges.pop(paper_id, None)
+
+    # Replace the SIMILAR_TO relationships with the exact K nearest neighbours of every paper
+    # (what GDS computes with sampleRate 1)
+    def run_knn(self, K):
+        paper_ids, coords = self.get_coords()
+        neighbours, scores = knn_graph(paper_ids, coords, K)
+
+        with self.lock:
+            self.edges = {}
+            for paper_id, targets, target_scores in zip(paper_ids, neighbours.tolist(), scores.tolist()):
+                self.edges[paper_id] = {target: score for target, score in zip(targets, target_scores) if target >= 0}
+        print("\nKNN graph built\n")
+
+    def stream_knn(self, K):
+        paper_ids, coords = self.get_coords()
+        neighbours, _ = knn_graph(paper_ids, coords, K)
+        return {paper_id: [target for target in targets if target >= 0] for paper_id, targets in zip(paper_ids, neighbours.tolist())}
+
+    def get_text(self):
+        papers = self._papers()
+        return [p["paper_id"] for p in papers], [p["author"] for p in papers], [p["title"] for p in papers]
+
+    def get_pdfs(self):
+        return {p["pdf"]: p["paper_id"] for p in self._papers()}
+
+    def get_layouts(self):
+        return {p["paper_id"]: p["layout"] for p in self._papers() if p["layout"] is not None}
+
+    def get_kth_scores(self):
+        with self.lock:
+            return {paper_id: (min(targets.values()), len(targets)) for paper_id, targets in self.edges.items() if targets}
+
+    def get_neighbours(self, paper_ids):
+        with self.lock:
+            return {paper_id: list(self.edges[paper_id].items()) for paper_id in paper_ids if self.edges.get(paper_id)}
+
+    def get_coords(self):
+        papers = self._papers()
+        return [p["paper_id"] for p in papers], [p["coord"] for p in papers]
+
+    def get_topic_probs(self):
+        papers = self._papers()
+        return [p["paper_id"] for p in papers], [p["topic_prob"] for p in papers]
+
+    def query_by_author(self, author, mode, match, fields=None, cursor=None, limit=None):
+        return self._query_by_text("author_lower", author, mode, match, fields, cursor, limit)
+
+    def query_by_title(self, title, mode, match, fields=None, cursor=None, limit=None):
+        return self._query_by_text("title_lower", title, mode, match, fields, cursor, limit)
+
+    def query_by_coord(self, coord, K, fields=None):
+        with self.lock:
+            if self._matrix is None:
+                paper_ids, coords = self.get_coords()
+                self._matrix = (np.asarray(paper_ids, dtype=np.int64), normalize(coords))
+            paper_ids, matrix = self._matrix
+
+        if len(paper_ids) == 0:
+            return []
+        rows, _ = top_k(normalize(np.atleast_2d(coord)), matrix, min(K, len(paper_ids)), 65536)
+        return self._project(paper_ids[rows[0]].tolist(), fields)
+
+    # Papers in the same order as the ids
+    def query_by_paper_ids(self, paper_ids, fields=None):
+        return self._project([paper_id for paper_id in paper_ids if paper_id in self.papers], fields)
+
+    # Nearest neighbours of the given papers
+    def query_related_by_paper_ids(self, paper_ids, fields=None, cursor=None, limit=None):
+        related = {target for paper_id in paper_ids for target in self.edges.get(paper_id, ())}
+        return self._project(self._page(related, cursor, limit), fields)
+
+    # The K papers with the highest probability for the topic
+    def query_by_topic_index(self, topic_idx, K, fields=None):
+        def prob(paper):
+            topic_prob = paper["topic_prob"] if paper["topic_prob"] is not None else ()
+            return topic_prob[topic_idx] if -len(topic_prob) <= topic_idx < len(topic_prob) else -np.inf
+
+        papers = sorted(self._papers(), key=prob, reverse=True)[:K]
+        return self._project([p["paper_id"] for p in papers], fields)
+
+    def query_by_paper_id(self, paper_id, K, mode, fields=None, cursor=None, limit=None):
+        # As in the Cypher queries, only papers with neighbours match
+        matches = [paper_id] if self.edges.get(paper_id) else []
+        return self._matches_or_related(matches, mode, fields, cursor, limit)
+
+    # Papers whose lower-cased property contains (or starts with) the text, or their neighbours
+    def _query_by_text(self, prop, text, mode, match, fields, cursor, limit):
+        text = text.lower()
+        if match == "prefix":
+            matches = [p["paper_id"] for p in self._papers() if p[prop].startswith(text) and self.edges.get(p["paper_id"])]
+        else:
+            matches = [p["paper_id"] for p in self._papers() if text in p[prop] and self.edges.get(p["paper_id"])]
+        return self._matches_or_related(matches, mode, fields, cursor, limit)
+
+    def _matches_or_related(self, matches, mode, fields, cursor, limit):
+        if mode == "exact": # Return only exact matches
+            return self._project(self._page(matches, cursor, limit), fields)
+        elif mode == "related": # Return only related papers
+            return self.query_related_by_paper_ids(matches, fields, cursor, limit)
+        else:
+            print("Query mode not supported!")
+            return
+
+    # Snapshot of the papers, safe to iterate while other threads write
+    def _papers(self):
+        with self.lock:
+            return list(self.papers.values())
+
+    # Page through paper ids in paper_id order: ids after cursor (if not None), at most limit (if not None)
+    @staticmethod
+    def _page(paper_ids, cursor, limit):
+        paper_ids = sorted(paper_id for paper_id in paper_ids if cursor is None or paper_id > cursor)
+        return paper_ids if limit is None else paper_ids[:limit]
+
+    # The requested fields of the papers, as new dicts (vectors as lists)
+    def _project(self, paper_ids, fields):
+        with timed("stage", "hydration"):
+            return self._fetch(paper_ids, fields)
+
+    def _fetch(self, paper_ids, fields):
+        fields = paper_fields(fields)
+        papers = []
+        for paper_id in paper_ids:
+            paper = self.papers[paper_id]
+            papers.append({field: paper[field].tolist() if isinstance(paper[field], np.ndarray) else paper[field] for field in fields})
+        return papers
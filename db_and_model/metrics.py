@@ -0,0 +1,115 @@
+'''
+Always-on latency histograms, exported in the Prometheus text format
+
+    with timed("stage", "lsi_projection"):
+        ...
+
+records the duration of the block in the infera_stage_seconds histogram, labelled stage="lsi_projection".
+'''
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+import sys
+from threading import Lock
+import time
+
+# Upper bounds (seconds) of the histogram buckets, the last bucket (+Inf) is implicit
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    '''
+
+    Latency histogram with one series per label value, e.g. one per stage
+
+    name: metric name; label: name of the label distinguishing the series; help: description
+
+    '''
+    def __init__(self, name, label, help, buckets=BUCKETS):
+        self.name = name
+        self.label = label
+        self.help = help
+        self.buckets = buckets
+        self.series = {} # label value -> [bucket counts (not cumulative), sum, count]
+        self.lock = Lock()
+
+    def observe(self, value, seconds):
+        i = bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(value)
+            if series is None:
+                series = self.series[value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        with self.lock:
+            series = {value: (list(counts), total, count) for value, (counts, total, count) in self.series.items()}
+
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        for value in sorted(series, key=str):
+            counts, total, count = series[value]
+            label = '{}="{}"'.format(self.label, _escape(value))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, le, cumulative))
+            lines.append("{}_sum{{{}}} {!r}".format(self.name, label, total))
+            lines.append("{}_count{{{}}} {}".format(self.name, label, count))
+        return "\n".join(lines)
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+HISTOGRAMS = {
+    # Query pipeline stages: tokenization, model projection, vector/text index search, database
+    # session acquisition and query execution, result hydration, JSON serialization
+    "stage": Histogram("infera_stage_seconds", "stage", "Time spent in each query processing stage"),
+    # Whole DbDriver build and query calls
+    "driver": Histogram("infera_driver_seconds", "method", "Duration of DbDriver build and query calls"),
+    # Whole HTTP requests, by route
+    "route": Histogram("infera_route_seconds", "route", "Duration of HTTP requests by route"),
+}
+
+# Record the duration of the block in a histogram ("stage", "driver" or "route") under label value
+@contextmanager
+def timed(histogram, value):
+    t_init = time.perf_counter()
+    try:
+        yield
+    finally:
+        HISTOGRAMS[histogram].observe(value, time.perf_counter() - t_init)
+
+def observe(histogram, value, seconds):
+    HISTOGRAMS[histogram].observe(value, seconds)
+
+# All histograms, plus gauges and counters given as (name, help, value), in the Prometheus
+# text format. Counter names end with _total
+def render(gauges=(), counters=()):
+    parts = [histogram.render() for histogram in HISTOGRAMS.values()]
+    for name, help, value in gauges:
+        parts.append("# HELP {0} {1}\n# TYPE {0} gauge\n{0} {2!r}".format(name, help, value))
+    for name, help, value in counters:
+        parts.append("# HELP {0} {1}\n# TYPE {0} counter\n{0} {2!r}".format(name, help, value))
+    return "\n".join(parts) + "\n"
+
+# Resident memory of the process in bytes (the peak resident memory where /proc is not
+# available, None on Windows)
+def resident_memory():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # bytes on macOS, KiB elsewhere
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
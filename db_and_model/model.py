@@ -1,25 +1,49 @@
 import gensim as gs
 import os as os
 import glob
+import hashlib
+import json
+import time
 from pathlib import Path
-
-from tika import parser
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from gensim.corpora.textcorpus import TextCorpus
 from gensim.test.utils import datapath
 from gensim import utils
 from gensim.corpora.mmcorpus import MmCorpus
 import gensim
+import numpy as np
 from gensim.corpora import Dictionary
+from gensim.matutils import MmWriter, corpus2csc
 
 from gensim.parsing.preprocessing import preprocess_string
 
-from gensim.models import LsiModel, LdaModel, LogEntropyModel
+from gensim.models import LsiModel, LdaModel, LdaMulticore, LogEntropyModel
+
+from metrics import timed
+
+# sep_limit of the model saves: arrays of at least this many elements (16 KiB of float32) are
+# saved to their own .npy files, which load() can memory-map. gensim documents sep_limit in bytes,
+# but compares it with the number of elements (ndarray.size, or nnz for sparse matrices)
+SEPARATE_ARRAY_SIZE = 4096
+
+# Saved model files, by SimilarityModel attribute
+MODEL_FILES = {
+    "dictionary": (Dictionary, "dictionary"),
+    "LogEntropyModel": (LogEntropyModel, "logentropy.model"),
+    "lsi_model": (LsiModel, "lsi.model"),
+    "lda_model": (LdaModel, "lda.model"),
+}
 
 class Corpus(TextCorpus):
 
-    def get_texts(self):
-        files = glob.glob(self.input + "*.txt")
+    def get_files(self):
+        return glob.glob(self.input + "*.txt")
+
+    def get_texts(self, files=None):
+        if files is None:
+            files = self.get_files()
         for file in files:
             file_object = open(file, 'rb')
             file_string = file_object.read()
@@ -27,19 +51,59 @@ class Corpus(TextCorpus):
             yield words
 
     def __len__(self):
-        self.length = sum(1 for _ in self.get_texts())
+        if self.length is None:
+            self.length = sum(1 for _ in self.get_files())
         return self.length
 
+class TimedCorpus:
+    '''
+    Streamed corpus printing the wall time and throughput of every full pass over it, i.e. of
+    every training pass of a model reading it
+    '''
+    def __init__(self, corpus, label):
+        self.corpus = corpus
+        self.label = label
+        self.passes = 0
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __iter__(self):
+        t_init = time.perf_counter()
+        count = 0
+        for document in self.corpus:
+            count += 1
+            yield document
+
+        # Partial reads (e.g. gensim peeking at the first document) are not reported
+        self.passes += 1
+        elapsed = time.perf_counter() - t_init
+        print("{} pass {}: {} documents in {:.1f} s ({:.0f} docs/s)".format(self.label, self.passes, count, elapsed, count / max(elapsed, 1e-9)))
+
 class SimilarityModel:
-    def __init__(self, corpus_path, model_path, num_latent_dimensions=10, num_topics=10):
+    '''
+
+    workers: number of processes training LDA (None: one per CPU core). Multicore training
+        (LdaMulticore) does not support alpha='auto', which is then trained in one process
+    chunksize: number of documents per training chunk (None: the gensim defaults, 20000 for
+        LSI and 2000 for LDA)
+    alpha: LDA document-topic prior, 'auto' (learned), 'symmetric' or 'asymmetric'
+
+    '''
+    def __init__(self, corpus_path, model_path, num_latent_dimensions=10, num_topics=10, workers=1, chunksize=None, alpha="auto"):
         self.corpus_path = corpus_path
         self.model_path = model_path
         self.num_latent_dimensions = num_latent_dimensions
         self.num_topics = num_topics
+        self.workers = workers
+        self.chunksize = chunksize
+        self.alpha = alpha
+        self.mmap = None # Memory-map mode of the model arrays for lazily loaded models
+        self.load_lock = Lock()
 
     def build(self):
-        self.corpus = Corpus(self.corpus_path)
-        self.dictionary = self.corpus.dictionary
+        # Tokenized once into an on-disk corpus, every training pass below streams from disk
+        self.corpus, self.dictionary = cache_corpus(self.corpus_path, self.model_path)
 
         lsi_model_file = open(self.model_path + "lsi.model","w+")
         lda_model_file = open(self.model_path + "lsi.model","w+")
@@ -49,23 +113,97 @@ class SimilarityModel:
         self.LogEntropyModel = LogEntropyModel(self.corpus)
         self.LogEntropyModel.save(self.model_path + "logentropy.model")
 
-        self.weighed_corpus = [self.LogEntropyModel[bow] for bow in self.corpus]
-        
-        self.lsi_model = LsiModel(self.weighed_corpus, num_topics=self.num_latent_dimensions)
-        self.lda_model = LdaModel(self.weighed_corpus, self.num_topics, self.dictionary, passes=5, alpha='auto')
+        MmCorpus.serialize(self.model_path + "weighed_corpus.mm", self.LogEntropyModel[self.corpus])
+        self.weighed_corpus = MmCorpus(self.model_path + "weighed_corpus.mm")
+
+        # LSI is trained in one streamed pass, chunk by chunk (using every core in the BLAS
+        # routines); LDA in 5 passes, by several worker processes unless alpha is learned
+        chunking = {} if self.chunksize is None else {"chunksize": self.chunksize}
+        workers = self.workers or os.cpu_count() or 1
+
+        # The vocabulary size is given so that gensim does not read the whole corpus once more to
+        # find it (FakeDict is what gensim would build)
+        t_init = time.perf_counter()
+        self.lsi_model = LsiModel(TimedCorpus(self.weighed_corpus, "LSI"), num_topics=self.num_latent_dimensions,
+                                  id2word=utils.FakeDict(len(self.dictionary)), **chunking)
+        print("LSI trained in {:.1f} s".format(time.perf_counter() - t_init))
+
+        t_init = time.perf_counter()
+        lda_corpus = TimedCorpus(self.weighed_corpus, "LDA")
+        if workers > 1 and self.alpha != "auto":
+            # The main process also reads the corpus and merges the workers' updates
+            print("Training LDA with {} worker processes".format(workers - 1))
+            self.lda_model = LdaMulticore(lda_corpus, self.num_topics, self.dictionary, workers=workers - 1, passes=5, alpha=self.alpha, **chunking)
+        else:
+            if workers > 1:
+                print("alpha='auto' is only supported by single-process LDA training")
+            self.lda_model = LdaModel(lda_corpus, self.num_topics, self.dictionary, passes=5, alpha=self.alpha, **chunking)
+        print("LDA trained in {:.1f} s".format(time.perf_counter() - t_init))
+
+        self.save_models()
+
+    def update(self, filenames):
+        '''
+
+        Updates the dictionary and the LDA model online with new documents instead of
+        retraining them (LdaModel.update).
+
+        The LSI model is kept as is: updating it (LsiModel.add_documents) recomputes the SVD and
+        rotates the latent space, which would leave the stored coordinates of every existing
+        paper in a different space from the new papers and the queries. New terms are added to
+        the dictionary, but LogEntropy, LSI and LDA keep the vocabulary they were trained with,
+        so those terms get no weight until the next full build.
+
+        '''
+        texts = Corpus(self.corpus_path, dictionary=Dictionary())
+        files = [self.corpus_path + filename + ".txt" for filename in filenames]
+        words = list(texts.get_texts([file for file in files if os.path.exists(file)]))
+        if not words:
+            return
 
-        self.lsi_model.save(self.model_path + "lsi.model")
-        self.lda_model.save(self.model_path + "lda.model")
-        self.corpus.dictionary.save(self.model_path + "dictionary")
+        self.dictionary.add_documents(words)
+        weighed_corpus = [self.LogEntropyModel[self.dictionary.doc2bow(document)] for document in words]
+
+        self.lda_model.update(weighed_corpus)
+
+        self.save_models()
+
+    # Save the dictionary and the LSI and LDA models, with their large arrays in separate files
+    def save_models(self):
+        self.lsi_model.save(self.model_path + "lsi.model", sep_limit=SEPARATE_ARRAY_SIZE)
+        self.lda_model.save(self.model_path + "lda.model", sep_limit=SEPARATE_ARRAY_SIZE)
+        self.dictionary.save(self.model_path + "dictionary")
+
+    def load(self, mmap=None, lazy=False):
+        '''
 
-        self.set_topic_terms()
+        Loads the saved dictionary and models. With mmap='r', model arrays saved to separate files
+        are memory-mapped read-only instead of read into memory (the models can then not be
+        updated). If lazy, each model is only loaded when first used, e.g. the LDA model is not
+        loaded by a server that only answers topic searches.
 
-    def load(self):
-        self.dictionary = Dictionary.load(self.model_path + "dictionary")
-        self.lsi_model = LsiModel.load(self.model_path + "lsi.model")
-        self.LogEntropyModel = LogEntropyModel.load(self.model_path + "logentropy.model")
-        self.lda_model = LdaModel.load(self.model_path + "lda.model")
-        self.set_topic_terms()
+        '''
+        self.mmap = mmap
+        for name in MODEL_FILES:
+            self.__dict__.pop(name, None)
+        if not lazy:
+            for name in MODEL_FILES:
+                self._load_model(name)
+
+    # Models not loaded yet are loaded on first access (only after load(lazy=True))
+    def __getattr__(self, name):
+        if name not in MODEL_FILES:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        return self._load_model(name)
+
+    def _load_model(self, name):
+        with self.load_lock:
+            if name not in self.__dict__:
+                model_class, filename = MODEL_FILES[name]
+                t_init = time.perf_counter()
+                self.__dict__[name] = model_class.load(self.model_path + filename, mmap=self.mmap)
+                print("Loaded {} in {:.2f} s".format(filename, time.perf_counter() - t_init))
+            return self.__dict__[name]
     
     def test_lsi(self):
         topics = self.lsi_model.show_topics(-1, formatted=False)
@@ -111,29 +249,239 @@ class SimilarityModel:
         weighed_bow = self.LogEntropyModel[bow]
         return self.lsi_model[weighed_bow], self.lda_model.get_document_topics(weighed_bow, minimum_probability=0.0)
 
+    def document_map_batch(self, filenames, workers=None, chunksize=256):
+        '''
+
+        Maps many input filenames to lsi model co-ordinates and LDA topics. Files are read and
+        preprocessed in parallel worker processes, then projected chunksize documents at a time.
+
+        Returns two dense float32 arrays, one row per file: LSI co-ordinates (missing dimensions
+        set to float64 eps, as in DbDriver) and LDA topic probabilities
+
+        '''
+        paths = [self.corpus_path + filename + ".txt" for filename in filenames]
+        coords = np.full((len(paths), self.num_latent_dimensions), np.finfo(np.float64).eps, dtype=np.float32)
+        topic_probs = np.zeros((len(paths), self.num_topics), dtype=np.float32)
+
+        workers = workers or os.cpu_count() or 1
+        if workers > 1:
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=init_bow_worker, initargs=(self.dictionary,))
+            bows = pool.map(file_to_bow, paths, chunksize=16)
+        else:
+            pool = None
+            init_bow_worker(self.dictionary)
+            bows = map(file_to_bow, paths)
+
+        try:
+            chunk = []
+            start = 0
+            for bow in bows:
+                chunk.append(self.LogEntropyModel[bow])
+                if len(chunk) == chunksize:
+                    self._project_chunk(chunk, coords[start:start + len(chunk)], topic_probs[start:start + len(chunk)])
+                    start += len(chunk)
+                    chunk = []
+            if chunk:
+                self._project_chunk(chunk, coords[start:], topic_probs[start:])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        return coords, topic_probs
+
+    # Project a chunk of weighed bag-of-words vectors through LSI and LDA, writing into the given rows
+    def _project_chunk(self, chunk, coords, topic_probs):
+        lsi_coords = self.project_lsi(chunk)
+        dims = min(lsi_coords.shape[1], coords.shape[1])
+        coords[:, :dims] = np.where(lsi_coords[:, :dims] == 0, coords[:, :dims], lsi_coords[:, :dims])
+
+        # Same normalization as LdaModel.get_document_topics, for the whole chunk at once
+        gamma, _ = self.lda_model.inference(chunk)
+        probs = gamma / gamma.sum(axis=1, keepdims=True)
+        probs[probs < 1e-8] = 0
+        topics = min(probs.shape[1], topic_probs.shape[1])
+        topic_probs[:, :topics] = probs[:, :topics]
+
+    def project_lsi(self, weighed_bows):
+        '''
+        Projects weighed bag-of-words vectors into LSI space with a single sparse matrix product.
+        Returns a dense array with one row per vector
+        '''
+        vectors = corpus2csc(weighed_bows, num_terms=self.lsi_model.num_terms, num_docs=len(weighed_bows))
+        projection = self.lsi_model.projection.u[:, :self.lsi_model.num_topics]
+        return np.asarray(vectors.T @ projection)
 
 
     def string_lookup(self, input_string):
         '''
         String-to-lsi lookup
         '''
-        words = preprocess_string(input_string)
-        bow = self.dictionary.doc2bow(words)
-        weighed_bow = self.LogEntropyModel[bow]
-        return self.lsi_model[weighed_bow]
+        with timed("stage", "tokenize"):
+            words = preprocess_string(input_string)
+            bow = self.dictionary.doc2bow(words)
+        with timed("stage", "lsi_projection"):
+            weighed_bow = self.LogEntropyModel[bow]
+            return self.lsi_model[weighed_bow]
+
+    def strings_lookup(self, input_strings):
+        '''
+        Batched string_lookup: projects many strings into LSI space with a single sparse matrix
+        product. Returns a dense float32 array with one row per string
+        '''
+        with timed("stage", "tokenize"):
+            bows = [self.dictionary.doc2bow(preprocess_string(string)) for string in input_strings]
+        with timed("stage", "lsi_projection"):
+            weighed_bows = [self.LogEntropyModel[bow] for bow in bows]
+            return self.project_lsi(weighed_bows).astype(np.float32)
+
+def init_bow_worker(dictionary):
+    global worker_dictionary
+    worker_dictionary = dictionary
+
+def file_to_bow(path):
+    '''
+    Reads and preprocesses a text file in a worker, returning its bag-of-words vector
+    '''
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            string = file.read()
+    else:
+        print("Document map is using an empty string")
+        string = ""
+    return worker_dictionary.doc2bow(preprocess_string(string))
+
+def cache_corpus(corpus_path, cache_path):
+    '''
+
+    Tokenizes every text file in corpus_path once and serializes the bag-of-words vectors to a
+    Matrix Market file (corpus.mm) in cache_path, along with its dictionary and the list of
+    files it was built from. The number of documents is stored in the Matrix Market header.
+
+    The cache is reused as long as no text file was added, removed or modified since it was
+    written. Returns the streamed corpus and its dictionary.
 
-def pdf_to_text(input_path, output_path):
+    '''
+    corpus_file = cache_path + "corpus.mm"
+    dictionary_file = cache_path + "corpus.dict"
+    files_file = cache_path + "corpus_files.json"
+
+    # Passing an empty dictionary skips TextCorpus's own tokenization pass
+    texts = Corpus(corpus_path, dictionary=Dictionary())
+    files = texts.get_files()
+
+    if os.path.exists(corpus_file) and os.path.exists(files_file) and os.path.exists(dictionary_file):
+        with open(files_file, 'r', encoding='utf-8') as f:
+            cached_files = json.load(f)
+        newest = max((os.path.getmtime(file) for file in files), default=0)
+        if cached_files == files and os.path.getmtime(corpus_file) >= newest:
+            print("Using cached corpus: {}".format(corpus_file))
+            return MmCorpus(corpus_file), Dictionary.load(dictionary_file)
+
+    dictionary = texts.dictionary
+    bows = (dictionary.doc2bow(words, allow_update=True) for words in texts.get_texts(files))
+    offsets = MmWriter.write_corpus(corpus_file, bows, index=True)
+    utils.pickle(offsets, corpus_file + ".index")
+    dictionary.save(dictionary_file)
+
+    with open(files_file, 'w', encoding='utf-8') as f:
+        json.dump(files, f)
+
+    return MmCorpus(corpus_file), dictionary
+
+def pdf_to_text(input_path, output_path, workers=None, use_processes=False):
+    '''
+
+    Converts every PDF under input_path to a .txt file in output_path.
+
+    PDFs whose text file is newer than the PDF, or whose content hash matches the one recorded
+    in the conversion manifest, are skipped. The rest are converted in a thread pool (or a
+    process pool if use_processes), with at most 2 * workers files queued at once.
+
+    '''
     files = glob.glob(input_path + "*/*.pdf")
+    manifest_path = output_path + "conversion_manifest.json"
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
 
+    todo = []
     for file in files:
-        print(file)
-        parsed_pdf = parser.from_file(file)
-        file_text = parsed_pdf['content']
-        if file_text is None: file_text = ""
         new_file_name = output_path + Path(file).stem + ".txt"
-        text_file = open(new_file_name, 'w', encoding='utf-8')
-        text_file.write(file_text)
-        text_file.close()
+        if os.path.exists(new_file_name):
+            if os.path.getmtime(new_file_name) >= os.path.getmtime(file):
+                continue
+            entry = manifest.get(file)
+            if entry is not None and entry["sha1"] == file_hash(file):
+                os.utime(new_file_name) # Unchanged content, mark the text file as up to date
+                continue
+        todo.append((file, new_file_name))
+
+    print("Converting {} PDFs ({} up to date)".format(len(todo), len(files) - len(todo)))
+    if not todo:
+        return
+
+    workers = workers or os.cpu_count() or 1
+    pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    t_init = time.perf_counter()
+    converted = 0
+    failed = 0
+    next_report = 100
+
+    with pool_class(max_workers=workers) as pool:
+        pending = set()
+        jobs = iter(todo)
+        while True:
+            # Keep the queue of submitted files bounded
+            for file, new_file_name in jobs:
+                pending.add(pool.submit(convert_pdf, file, new_file_name))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    file, sha1 = future.result()
+                    manifest[file] = {"sha1": sha1}
+                    converted += 1
+                except Exception as err:
+                    print("Could not convert PDF: {}".format(err))
+                    failed += 1
+
+            finished = converted + failed
+            if finished >= next_report or finished == len(todo):
+                next_report += 100
+                elapsed = time.perf_counter() - t_init
+                print("[{}/{}] {:.1f} files/s".format(finished, len(todo), finished / elapsed))
+
+    with open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    elapsed = time.perf_counter() - t_init
+    print("Converted {} PDFs, {} failed, in {:.1f} s ({:.1f} files/s)".format(converted, failed, elapsed, converted / elapsed))
+
+def convert_pdf(file, new_file_name):
+    '''
+    Extracts the text of a single PDF. Returns the PDF path and its content hash
+    '''
+    from tika import parser
+
+    parsed_pdf = parser.from_file(file)
+    file_text = parsed_pdf['content']
+    if file_text is None: file_text = ""
+    text_file = open(new_file_name, 'w', encoding='utf-8')
+    text_file.write(file_text)
+    text_file.close()
+    return file, file_hash(file)
+
+def file_hash(file):
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
 
 if __name__ == '__main__':
     #pdf_to_text(r"/Users/kamranramji/Documents/NeurIPS", r"/Users/kamranramji/Documents/InferaCapstone/NeurIPSText")
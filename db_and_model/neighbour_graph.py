@@ -0,0 +1,123 @@
+import numpy as np
+from backend import VECTOR_DTYPE, VECTOR_FIELDS, paper_fields
+
+class NeighbourGraph:
+    '''
+
+    In-process copy of the KNN graph and of the paper properties, for related-paper queries
+    without a database round trip. The graph is stored in compressed sparse row form: the
+    neighbours of the paper at row r are targets[offsets[r]:offsets[r + 1]] (int32 rows, by
+    decreasing score) with their float32 scores. Rows are the papers sorted by paper_id. The
+    paper table has one list per text property and one read-only float32 matrix per vector property.
+
+    '''
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.targets = np.empty(0, dtype=np.int32)
+        self.scores = np.empty(0, dtype=np.float32)
+        self.columns = {} # paper field -> list of values, or float32 matrix for vector fields
+        self.present = {} # vector field -> bool array, rows that have the vector
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_edges(self):
+        return len(self.targets)
+
+    # papers: dicts with every paper field; neighbours: paper_id -> list of (paper_id, score)
+    def build(self, papers, neighbours):
+        papers = sorted(papers, key=lambda paper: paper["paper_id"])
+        self.ids = np.array([paper["paper_id"] for paper in papers], dtype=np.int64)
+
+        for field in paper_fields(None):
+            values = [paper.get(field) for paper in papers]
+            if field not in VECTOR_FIELDS:
+                self.columns[field] = values
+                continue
+            present = np.array([value is not None for value in values], dtype=bool)
+            dim = max((len(value) for value in values if value is not None), default=0)
+            matrix = np.zeros((len(values), dim), dtype=VECTOR_DTYPE)
+            for row in np.flatnonzero(present):
+                matrix[row, :len(values[row])] = values[row]
+            matrix.flags.writeable = False
+            self.columns[field] = matrix
+            self.present[field] = present
+
+        counts = np.zeros(len(self.ids), dtype=np.int64)
+        targets = []
+        scores = []
+        for row, paper_id in enumerate(self.ids.tolist()):
+            edges = sorted(neighbours.get(paper_id, ()), key=lambda edge: -edge[1])
+            rows = self._rows([target for target, _ in edges])
+            found = rows >= 0
+            counts[row] = np.count_nonzero(found)
+            targets.append(rows[found].astype(np.int32))
+            scores.append(np.array([score for _, score in edges], dtype=np.float32)[found])
+
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.targets = np.concatenate(targets) if targets else np.empty(0, dtype=np.int32)
+        self.scores = np.concatenate(scores) if scores else np.empty(0, dtype=np.float32)
+
+    # Whether the paper is in the graph with at least one neighbour
+    def has_neighbours(self, paper_id):
+        row = self._rows([paper_id])[0]
+        return row >= 0 and self.offsets[row + 1] > self.offsets[row]
+
+    # Neighbour paper ids and scores of a paper, by decreasing score
+    def neighbours(self, paper_id):
+        row = self._rows([paper_id])[0]
+        if row < 0:
+            return [], []
+        begin, end = self.offsets[row], self.offsets[row + 1]
+        return self.ids[self.targets[begin:end]].tolist(), self.scores[begin:end].tolist()
+
+    # Ids of the papers reached from the given papers in 1 to hops steps, sorted. With hops=1,
+    # the distinct neighbours of the papers (as the SIMILAR_TO traversal of the DB queries); with
+    # more hops, the given papers themselves are left out
+    def expand(self, paper_ids, hops=1):
+        reached = np.zeros(len(self.ids), dtype=bool)
+        seeds = self._rows(paper_ids)
+        seeds = seeds[seeds >= 0]
+        frontier = seeds
+
+        for _ in range(hops):
+            if len(frontier) == 0:
+                break
+            # Concatenated neighbour lists of the frontier rows
+            begins = self.offsets[frontier]
+            counts = self.offsets[frontier + 1] - begins
+            steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            found = np.unique(self.targets[np.repeat(begins, counts) + steps])
+            frontier = found[~reached[found]]
+            reached[frontier] = True
+
+        if hops > 1:
+            reached[seeds] = False
+        return self.ids[reached].tolist()
+
+    # The requested fields (all if None) of the papers in the table, in the same order as the
+    # ids, as new dicts. Vectors are read-only float32 array rows, serialized as they are by the
+    # JSON encoder
+    def papers(self, paper_ids, fields=None):
+        fields = paper_fields(fields)
+        rows = self._rows(paper_ids)
+        papers = []
+        for row in rows[rows >= 0].tolist():
+            paper = {}
+            for field in fields:
+                if field in self.present:
+                    paper[field] = self.columns[field][row] if self.present[field][row] else None
+                else:
+                    paper[field] = self.columns[field][row]
+            papers.append(paper)
+        return papers
+
+    # Rows of the paper ids in the table (-1 if absent)
+    def _rows(self, paper_ids):
+        paper_ids = np.asarray(paper_ids, dtype=np.int64).reshape(-1)
+        if len(self.ids) == 0:
+            return np.full(len(paper_ids), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.ids, paper_ids), len(self.ids) - 1)
+        return np.where(self.ids[rows] == paper_ids, rows, -1)
@@ -0,0 +1,505 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+from neo4j import GraphDatabase
+from backend import pack_vector, paper_fields, unpack_vector
+from metrics import observe, timed
+
+# Cypher map projection of the requested paper fields (all if None) of node p. Vectors with a
+# packed copy are read from it (from the list on nodes written before the copies existed)
+def _projection(fields):
+    return "p {" + ", ".join("{0}: coalesce(p.{0}_f32, p.{0})".format(field) if field in PACKED_COPIES else "." + field
+                             for field in paper_fields(fields)) + "}"
+
+# Cypher clause to page through papers p ordered by paper_id. Uses the $cursor (last paper_id
+# already returned, or null) and $limit (if not None) query parameters
+def _page(limit):
+    page = "WHERE $cursor IS NULL OR p.paper_id > $cursor WITH p ORDER BY p.paper_id"
+    if limit is not None:
+        page += " LIMIT $limit"
+    return page
+
+# Vector properties stored as packed float32 byte arrays
+PACKED_FIELDS = ["layout"]
+
+# Vector properties stored both as lists of floats, which Cypher reads in the database
+# (gds.beta.knn and gds.alpha.similarity.cosine for coord, the topic ranking query for
+# topic_prob), and as a packed float32 copy (<field>_f32) from which they are returned
+PACKED_COPIES = ["coord", "topic_prob"]
+
+# Node properties of a paper row, with the packed vectors and copies as bytes
+def _pack_row(row):
+    row = dict(row)
+    for field in PACKED_COPIES:
+        if row.get(field) is not None:
+            row[field + "_f32"] = pack_vector(row[field])
+            row[field] = np.asarray(row[field], dtype=np.float64).tolist()
+    for field in PACKED_FIELDS:
+        if row.get(field) is not None:
+            row[field] = pack_vector(row[field])
+    return row
+
+# Papers of a query result (streamed from the server), with the packed vectors as lists,
+# timed as the hydration stage
+def _hydrate(result):
+    with timed("stage", "hydration"):
+        papers = [dict(r["P"]) for r in result]
+        for paper in papers:
+            for field in PACKED_FIELDS + PACKED_COPIES:
+                if paper.get(field) is not None:
+                    paper[field] = unpack_vector(paper[field]).tolist()
+        return papers
+
+class Neo4jBackend:
+    '''
+
+    Papers stored as :Paper nodes in a Neo4j server, neighbours as SIMILAR_TO relationships.
+    Each call runs in its own session (or in the session of the enclosing session() block),
+    with connections taken from the driver's bounded pool; the KNN graph is built with the GDS plugin.
+
+    '''
+
+    # Connect to the DB. Sessions wait at most pool_timeout seconds for one of the pool_size
+    # connections, which are replaced after pool_lifetime seconds
+    def __init__(self, uri, user, password, pool_size=100, pool_timeout=60, pool_lifetime=3600):
+        self.driver = GraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=pool_size,
+                                           connection_acquisition_timeout=pool_timeout,
+                                           max_connection_lifetime=pool_lifetime)
+        self.graph_name = 'neuripsGraph' # Name of the GDS graph
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.local = threading.local() # Session of the session() block running in each thread
+        self.stats_lock = threading.Lock()
+        self.in_use = 0 # Sessions currently open
+        self.peak_in_use = 0
+        self.sessions = 0 # Sessions opened in total
+
+    # Close DB connection
+    def close(self):
+        self.driver.close()
+
+    # Open connections to the server ahead of the first requests: connections sessions each hold
+    # a connection (with a transaction running RETURN 1) at the same time, then return it to the pool
+    def warm_up(self, connections):
+        connections = min(connections, self.pool_size)
+        if connections <= 0:
+            return
+        barrier = threading.Barrier(connections, timeout=self.pool_timeout)
+
+        def connect(_):
+            with self._session() as session:
+                with session.begin_transaction() as tx:
+                    tx.run("RETURN 1").consume()
+                    barrier.wait()
+
+        with ThreadPoolExecutor(connections) as executor:
+            list(executor.map(connect, range(connections)))
+        print("\nWarmed up {} database connections\n".format(connections))
+
+    # Session and connection pool counters. idle_connections relies on an internal attribute of
+    # the driver's pool and is omitted if the driver does not have it
+    def pool_stats(self):
+        with self.stats_lock:
+            stats = {"size": self.pool_size, "sessions_in_use": self.in_use,
+                     "sessions_in_use_peak": self.peak_in_use, "sessions_opened": self.sessions}
+        try:
+            stats["idle_connections"] = sum(sum(1 for c in conns if not getattr(c, "in_use", False))
+                                            for conns in list(self.driver._pool.connections.values()))
+        except (AttributeError, TypeError):
+            pass
+        return stats
+
+    # Run the reads of the block (e.g. the queries of one request) in one session instead of a
+    # new session per query. Nested blocks use the outer session
+    @contextmanager
+    def session(self):
+        if getattr(self.local, "session", None) is not None:
+            yield
+            return
+        with self._session() as session:
+            self.local.session = session
+            try:
+                yield
+            finally:
+                self.local.session = None
+
+    # New driver session, counted in pool_stats
+    @contextmanager
+    def _session(self):
+        with self.stats_lock:
+            self.in_use += 1
+            self.sessions += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        try:
+            with self.driver.session() as session:
+                yield session
+        finally:
+            with self.stats_lock:
+                self.in_use -= 1
+
+    # Remove all papers and the GDS KNN graph (if any)
+    def destroy(self):
+        with self._session() as session:
+            session.write_transaction(self._destroy_gds_graph, self.graph_name)
+            session.write_transaction(self._destroy_db)
+
+    # Create the DB indexes used by queries (if they do not exist yet) and fill the
+    # lower-cased author/title properties of papers inserted without them
+    def create_indexes(self):
+        with self._session() as session:
+            session.run("CREATE INDEX paper_id_index IF NOT EXISTS FOR (p:Paper) ON (p.paper_id)")
+            session.run("CREATE INDEX paper_author_index IF NOT EXISTS FOR (p:Paper) ON (p.author_lower)")
+            session.run("CREATE INDEX paper_title_index IF NOT EXISTS FOR (p:Paper) ON (p.title_lower)")
+            session.write_transaction(self._set_lower_properties)
+
+    def insert_node(self, paper_id, pdf, author, title, year, coord, topic_prob):
+        row = _pack_row({"coord": coord, "topic_prob": topic_prob})
+        self._write(self._insert_node, paper_id, pdf, author, title, year, row["coord"], row["topic_prob"],
+                    row["coord_f32"], row["topic_prob_f32"])
+
+    # rows: list of dicts with the paper properties
+    def insert_nodes(self, rows):
+        self._write(self._insert_nodes, [_pack_row(row) for row in rows])
+
+    # rows: list of dicts with source and target paper_id and score
+    def insert_edges(self, rows):
+        self._write(self._insert_edges, rows)
+
+    def delete_edges(self, paper_ids):
+        self._write(self._delete_edges, paper_ids)
+
+    # Write the K nearest neighbours of every paper as SIMILAR_TO relationships with GDS
+    def run_knn(self, K):
+        with self._session() as session:
+            # Destroy GDS graph if it exists
+            session.write_transaction(self._destroy_gds_graph, self.graph_name)
+            # Create GDS graph
+            session.write_transaction(self._create_gds_graph, self.graph_name)
+            print("\nCreated GDS graph\n")
+            session.write_transaction(self._run_knn, self.graph_name, K)
+            print("\nKNN graph built\n")
+
+    # K nearest neighbours of every paper as computed by GDS, without writing them.
+    # Returns a dict paper_id -> neighbour paper_ids
+    def stream_knn(self, K):
+        with self._session() as session:
+            session.write_transaction(self._destroy_gds_graph, self.graph_name)
+            session.write_transaction(self._create_gds_graph, self.graph_name)
+            reference = session.read_transaction(self._stream_knn, self.graph_name, K)
+            session.write_transaction(self._destroy_gds_graph, self.graph_name)
+        return reference
+
+    def get_text(self):
+        return self._read(self._get_text)
+
+    def get_pdfs(self):
+        return self._read(self._get_pdfs)
+
+    def get_layouts(self):
+        return self._read(self._get_layouts)
+
+    def get_kth_scores(self):
+        return self._read(self._get_kth_scores)
+
+    def get_neighbours(self, paper_ids):
+        return self._read(self._get_neighbours, paper_ids)
+
+    def get_coords(self):
+        return self._read(self._get_coords)
+
+    def get_topic_probs(self):
+        return self._read(self._get_topic_probs)
+
+    def query_by_author(self, author, mode, match, fields=None, cursor=None, limit=None):
+        return self._read(self._query_by_author, author, mode, match, fields, cursor, limit)
+
+    def query_by_title(self, title, mode, match, fields=None, cursor=None, limit=None):
+        return self._read(self._query_by_title, title, mode, match, fields, cursor, limit)
+
+    def query_by_coord(self, coord, K, fields=None):
+        return self._read(self._query_by_coord, coord, K, fields)
+
+    def query_by_paper_ids(self, paper_ids, fields=None):
+        return self._read(self._query_by_paper_ids, paper_ids, fields)
+
+    def query_related_by_paper_ids(self, paper_ids, fields=None, cursor=None, limit=None):
+        return self._read(self._query_related_by_paper_ids, paper_ids, fields, cursor, limit)
+
+    def query_by_topic_index(self, topic_idx, K, fields=None):
+        return self._read(self._query_by_topic_index, topic_idx, K, fields)
+
+    def query_by_paper_id(self, paper_id, K, mode, fields=None, cursor=None, limit=None):
+        return self._read(self._query_by_paper_id, paper_id, K, mode, fields, cursor, limit)
+
+    # Run a read transaction in the session of the enclosing session() block, or in a new session.
+    # The time until the transaction function starts (connection acquisition and BEGIN) is
+    # recorded as the db_session stage
+    def _read(self, tx_function, *args):
+        t_init = time.perf_counter()
+        def run(tx, *args):
+            observe("stage", "db_session", time.perf_counter() - t_init)
+            return tx_function(tx, *args)
+
+        session = getattr(self.local, "session", None)
+        if session is not None:
+            return session.read_transaction(run, *args)
+        with self._session() as session:
+            return session.read_transaction(run, *args)
+
+    # Run a write transaction in a new session
+    def _write(self, tx_function, *args):
+        with self._session() as session:
+            return session.write_transaction(tx_function, *args)
+
+    ###### STATIC METHODS TO RUN CYPHER QUERIES ######
+
+    # Insert a node in the DB given its properties
+    @staticmethod
+    def _insert_node(tx, paper_id, pdf, author, title, year, coord, topic_prob, coord_f32, topic_prob_f32):
+        result = tx.run("MERGE (p:Paper {paper_id:$paper_id, pdf:$pdf, author:$author, title:$title, year:$year}) \
+                        SET p.coord = $coord, p.coord_f32 = $coord_f32 \
+                        SET p.topic_prob = $topic_prob, p.topic_prob_f32 = $topic_prob_f32 \
+                        SET p.author_lower = toLower($author), p.title_lower = toLower($title)", \
+                        paper_id=paper_id, pdf=pdf, author=author, title=title, year=year, coord=coord, topic_prob=topic_prob,
+                        coord_f32=coord_f32, topic_prob_f32=topic_prob_f32)
+
+    # Insert a batch of nodes in the DB. rows: list of dicts with the node properties
+    @staticmethod
+    def _insert_nodes(tx, rows):
+        result = tx.run("UNWIND $rows AS row \
+                        MERGE (p:Paper {paper_id:row.paper_id, pdf:row.pdf, author:row.author, title:row.title, year:row.year}) \
+                        SET p.coord = row.coord, p.coord_f32 = row.coord_f32 \
+                        SET p.topic_prob = row.topic_prob, p.topic_prob_f32 = row.topic_prob_f32 \
+                        SET p.layout = row.layout \
+                        SET p.author_lower = toLower(row.author), p.title_lower = toLower(row.title)", rows=rows)
+
+    # Create a batch of SIMILAR_TO relationships
+    @staticmethod
+    def _insert_edges(tx, rows):
+        result = tx.run("UNWIND $rows AS row \
+                        MATCH (p1:Paper {paper_id:row.source}) \
+                        MATCH (p2:Paper {paper_id:row.target}) \
+                        MERGE (p1)-[s:SIMILAR_TO]->(p2) \
+                        SET s.score = row.score", rows=rows)
+
+    # Delete the outgoing SIMILAR_TO relationships of a batch of papers
+    @staticmethod
+    def _delete_edges(tx, paper_ids):
+        result = tx.run("UNWIND $paper_ids AS paper_id \
+                        MATCH (p:Paper {paper_id:paper_id})-[s:SIMILAR_TO]->() \
+                        DELETE s", paper_ids=paper_ids)
+
+    # Create the GDS graph in the catalog using native projection
+    @staticmethod
+    def _create_gds_graph(tx, name):
+        result = tx.run("CALL gds.graph.create($name, {Paper: {label: 'Paper', \
+                        properties: { \
+                            coord: { \
+                                property: 'coord' \
+                            } \
+                        }}}, '*') ", name=name)
+
+    # Destroy GDS graph
+    @staticmethod
+    def _destroy_gds_graph(tx, name):
+        result = tx.run("CALL gds.graph.drop($name, false) ", name=name)
+
+    # Runs the KNN algo in the graph database based on cosine similarity
+    @staticmethod
+    def _run_knn(tx, name, K):
+        result = tx.run("CALL gds.beta.knn.write($name,{writeRelationshipType: 'SIMILAR_TO', \
+                        writeProperty: 'score', topK: $K, sampleRate: 1, deltaThreshold: 0, \
+                        maxIterations: 1000, randomSeed: 0, nodeWeightProperty: 'coord'}) \
+                        YIELD nodesCompared, relationshipsWritten ", name=name, K=K)
+
+    # Stream the GDS KNN result without writing it, as a dict paper_id -> neighbour paper_ids
+    @staticmethod
+    def _stream_knn(tx, name, K):
+        result = tx.run("CALL gds.beta.knn.stream($name,{topK: $K, sampleRate: 1, deltaThreshold: 0, \
+                        maxIterations: 1000, randomSeed: 0, nodeWeightProperty: 'coord'}) \
+                        YIELD node1, node2 \
+                        RETURN gds.util.asNode(node1).paper_id AS source, gds.util.asNode(node2).paper_id AS target ",
+                        name=name, K=K)
+
+        neighbours = {}
+        for r in result:
+            neighbours.setdefault(r["source"], []).append(r["target"])
+        return neighbours
+
+    # Query DB by author. Return matching papers and their nearest neighbours
+    @staticmethod
+    def _query_by_author(tx, author, mode, match, fields=None, cursor=None, limit=None):
+        op = "STARTS WITH" if match == "prefix" else "CONTAINS" # Both served by the author_lower index
+        if mode == "exact": # Return only exact matches
+            node = "p1"
+        elif mode == "related": # Return only related papers
+            node = "p2"
+        else:
+            print("Query mode not supported!")
+            return
+
+        result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE p1.author_lower \
+                        " + op + " $author WITH DISTINCT " + node + " AS p " + _page(limit) + " \
+                        RETURN " + _projection(fields) + " AS P ", author=author.lower(), cursor=cursor, limit=limit)
+
+        return _hydrate(result)
+
+    # Query DB by paper title. Return matching papers and their nearest neighbours
+    @staticmethod
+    def _query_by_title(tx, title, mode, match, fields=None, cursor=None, limit=None):
+        op = "STARTS WITH" if match == "prefix" else "CONTAINS" # Both served by the title_lower index
+        if mode == "exact": # Return only exact matches
+            node = "p1"
+        elif mode == "related":
+            node = "p2"
+        else:
+            print("Query mode not supported!")
+            return
+
+        result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE p1.title_lower \
+                        " + op + " $title WITH DISTINCT " + node + " AS p " + _page(limit) + " \
+                        RETURN " + _projection(fields) + " AS P ", title=title.lower(), cursor=cursor, limit=limit)
+
+        return _hydrate(result)
+
+    # Query DB by coordinates. Return the nearest neighbours to the given coordinate
+    @staticmethod
+    def _query_by_coord(tx, coord, K, fields=None):
+        result = tx.run("MATCH (p:Paper) WITH p, gds.alpha.similarity.cosine($coord, \
+                        p.coord) AS sim ORDER BY sim DESC LIMIT $K \
+                        RETURN " + _projection(fields) + " AS P ", coord=coord, K=K)
+
+        return _hydrate(result)
+
+    # Query DB by a list of paper ids. Return the papers in the same order as the ids
+    @staticmethod
+    def _query_by_paper_ids(tx, paper_ids, fields=None):
+        result = tx.run("UNWIND range(0, size($paper_ids) - 1) AS i \
+                        MATCH (p:Paper) WHERE p.paper_id = $paper_ids[i] \
+                        WITH p ORDER BY i RETURN " + _projection(fields) + " AS P ", paper_ids=paper_ids)
+
+        return _hydrate(result)
+
+    # Query DB by a list of paper ids. Return the nearest neighbours of those papers
+    @staticmethod
+    def _query_related_by_paper_ids(tx, paper_ids, fields=None, cursor=None, limit=None):
+        result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE p1.paper_id IN $paper_ids \
+                        WITH DISTINCT p2 AS p " + _page(limit) + " \
+                        RETURN " + _projection(fields) + " AS P ", paper_ids=paper_ids, cursor=cursor, limit=limit)
+
+        return _hydrate(result)
+
+    # Get the ids, authors and titles of every paper in the DB
+    @staticmethod
+    def _get_text(tx):
+        result = tx.run("MATCH (p:Paper) RETURN p.paper_id AS paper_id, p.author AS author, p.title AS title ")
+
+        paper_ids = []
+        authors = []
+        titles = []
+
+        for r in result:
+            paper_ids.append(r["paper_id"])
+            authors.append(r["author"])
+            titles.append(r["title"])
+
+        return paper_ids, authors, titles
+
+    # Set the lower-cased author/title properties on papers that do not have them
+    @staticmethod
+    def _set_lower_properties(tx):
+        result = tx.run("MATCH (p:Paper) WHERE p.title_lower IS NULL OR p.author_lower IS NULL \
+                        SET p.author_lower = toLower(p.author), p.title_lower = toLower(p.title) ")
+
+    # Get the PDF path and id of every paper in the DB, as a dict pdf -> paper_id
+    @staticmethod
+    def _get_pdfs(tx):
+        result = tx.run("MATCH (p:Paper) RETURN p.pdf AS pdf, p.paper_id AS paper_id ")
+
+        return {r["pdf"]: r["paper_id"] for r in result}
+
+    # Get the layout of every paper in the DB that has one, as a dict paper_id -> layout
+    @staticmethod
+    def _get_layouts(tx):
+        result = tx.run("MATCH (p:Paper) WHERE p.layout IS NOT NULL RETURN p.paper_id AS paper_id, p.layout AS layout ")
+
+        return {r["paper_id"]: unpack_vector(r["layout"]) for r in result}
+
+    # Get the lowest neighbour score and the number of neighbours of every paper with neighbours,
+    # as a dict paper_id -> (score, count)
+    @staticmethod
+    def _get_kth_scores(tx):
+        result = tx.run("MATCH (p:Paper)-[s:SIMILAR_TO]->(:Paper) \
+                        RETURN p.paper_id AS paper_id, min(s.score) AS score, count(s) AS count ")
+
+        return {r["paper_id"]: (r["score"], r["count"]) for r in result}
+
+    # Get the neighbours of the given papers, as a dict paper_id -> list of (neighbour paper_id, score)
+    @staticmethod
+    def _get_neighbours(tx, paper_ids):
+        result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE p1.paper_id IN $paper_ids \
+                        RETURN p1.paper_id AS paper_id, collect([p2.paper_id, s.score]) AS neighbours ", paper_ids=paper_ids)
+
+        return {r["paper_id"]: [tuple(neighbour) for neighbour in r["neighbours"]] for r in result}
+
+    # Get the ids and coordinates of every paper in the DB
+    @staticmethod
+    def _get_coords(tx):
+        result = tx.run("MATCH (p:Paper) RETURN p.paper_id AS paper_id, coalesce(p.coord_f32, p.coord) AS coord ")
+
+        paper_ids = []
+        coords = []
+
+        for r in result:
+            paper_ids.append(r["paper_id"])
+            coords.append(unpack_vector(r["coord"]) if r["coord"] is not None else None)
+
+        return paper_ids, coords
+
+    # Get the ids and LDA topic probabilities of every paper in the DB
+    @staticmethod
+    def _get_topic_probs(tx):
+        result = tx.run("MATCH (p:Paper) RETURN p.paper_id AS paper_id, coalesce(p.topic_prob_f32, p.topic_prob) AS topic_prob ")
+
+        paper_ids = []
+        topic_probs = []
+
+        for r in result:
+            paper_ids.append(r["paper_id"])
+            topic_probs.append(unpack_vector(r["topic_prob"]) if r["topic_prob"] is not None else [])
+
+        return paper_ids, topic_probs
+
+    # Query DB by model topic index. Return the K papers that have highest probability
+    # for the topic
+    @staticmethod
+    def _query_by_topic_index(tx, topic_idx, K, fields=None):
+        result = tx.run("MATCH (p:Paper) WITH p, p.topic_prob[$topic_idx] AS prob \
+                        ORDER BY prob DESC LIMIT $K \
+                        RETURN " + _projection(fields) + " AS P ", topic_idx=topic_idx, K=K)
+
+        return _hydrate(result)
+
+    # Query DB by paper id
+    @staticmethod
+    def _query_by_paper_id(tx, paper_id, K, mode, fields=None, cursor=None, limit=None):
+        if mode == "exact": # Return only exact matches
+            node = "p1"
+        elif mode == "related":
+            node = "p2"
+        else:
+            print("Query mode not supported!")
+            return
+
+        result = tx.run("MATCH (p1:Paper)-[s:SIMILAR_TO]->(p2:Paper) WHERE p1.paper_id \
+                        = $paper_id WITH DISTINCT " + node + " AS p " + _page(limit) + " \
+                        RETURN " + _projection(fields) + " AS P ", paper_id=paper_id, cursor=cursor, limit=limit)
+
+        return _hydrate(result)
+
+    # Remove all nodes and connections in the DB
+    @staticmethod
+    def _destroy_db(tx):
+        result = tx.run("MATCH(p:Paper) DETACH DELETE p")
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+class QueryCache:
+    '''
+
+    Size-bounded LRU cache for query results with a time-to-live.
+
+    maxsize: maximum number of cached results (0 disables the cache)
+    ttl: seconds after which a cached result expires (None: never)
+
+    '''
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (time stored, result)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Cache key for a query. Text is lowercased as the queries match it case-insensitively, and
+    # kept otherwise as is (whitespace is part of an author or title substring)
+    @staticmethod
+    def key(query_type, text, mode=None):
+        if isinstance(text, str):
+            text = text.lower()
+        return (query_type, text, mode)
+
+    # Return the cached result for key, or None if it is missing or expired
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result):
+        if self.maxsize <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (time.monotonic(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # Drop every cached result (e.g. after the graph or the model changed)
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations}
@@ -0,0 +1,163 @@
+'''
+Hyperparameter sweep of the number of LSI dimensions and LDA topics
+
+The corpus is tokenized once (reusing the corpus cache written by cache_corpus in the work
+directory, e.g. the model directory) and weighed with LogEntropy once. Every candidate number
+of LSI dimensions and of LDA topics is then trained in its own worker process, all reading the
+same weighed corpus from disk. LSI and LDA are independent of each other, so each value is
+trained once rather than once per (LSI, LDA) pair.
+
+Reports, for each model, the training time, the size of the saved model, the latency of
+embedding one query string and a quality score:
+- LSI: share of the energy (squared Frobenius norm) of the weighed corpus kept by the dimensions
+- LDA: u_mass topic coherence on the training documents (higher is better) and perplexity on
+  held-out documents (lower is better)
+
+    python sweep.py -text <TEXT_PATH> --work-dir <MODEL_PATH> --lsi 10,25,50,100 --lda 10,20,40
+'''
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from gensim import utils
+from gensim.corpora import Dictionary, MmCorpus
+from gensim.models import CoherenceModel, LdaModel, LogEntropyModel, LsiModel
+from gensim.parsing.preprocessing import preprocess_string
+from benchmark import measure, summarize
+from model import SEPARATE_ARRAY_SIZE, cache_corpus
+
+class Documents:
+    '''
+    Documents [start, stop) of a Matrix Market corpus, streamed from disk
+    '''
+    def __init__(self, path, start, stop):
+        self.path = path
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        return itertools.islice(MmCorpus(self.path), self.start, self.stop)
+
+# Tokenize (or reuse the cached corpus) and weigh the corpus once for every model of the sweep.
+# Returns the number of documents and the energy of the weighed corpus
+def prepare(text_path, work_path):
+    corpus, _ = cache_corpus(os.path.join(text_path, ""), os.path.join(work_path, ""))
+
+    log_entropy = LogEntropyModel(corpus)
+    log_entropy.save(os.path.join(work_path, "sweep_logentropy.model"))
+    MmCorpus.serialize(os.path.join(work_path, "sweep_weighed_corpus.mm"), log_entropy[corpus])
+
+    weighed = MmCorpus(os.path.join(work_path, "sweep_weighed_corpus.mm"))
+    energy = sum(value ** 2 for document in weighed for _, value in document)
+    return len(weighed), energy
+
+# Train LSI with the given number of dimensions on the whole corpus (in a worker process)
+def train_lsi(work_path, dims, num_docs, energy, queries):
+    dictionary = Dictionary.load(os.path.join(work_path, "corpus.dict"))
+    log_entropy = LogEntropyModel.load(os.path.join(work_path, "sweep_logentropy.model"))
+    documents = Documents(os.path.join(work_path, "sweep_weighed_corpus.mm"), 0, num_docs)
+
+    t_init = time.perf_counter()
+    lsi = LsiModel(documents, num_topics=dims, id2word=utils.FakeDict(len(dictionary)))
+    train_s = time.perf_counter() - t_init
+
+    model_path = os.path.join(work_path, "sweep", "lsi_{}".format(dims))
+    os.makedirs(model_path, exist_ok=True)
+    lsi.save(os.path.join(model_path, "lsi.model"), sep_limit=SEPARATE_ARRAY_SIZE)
+
+    # As SimilarityModel.string_lookup
+    embed = lambda query: lsi[log_entropy[dictionary.doc2bow(preprocess_string(query))]]
+
+    return {"model": "lsi", "size": dims, "train_s": train_s, "model_bytes": _size(model_path),
+            "query": summarize(measure(embed, [(query,) for query in queries])),
+            "energy": float(np.sum(lsi.projection.s ** 2) / max(energy, 1e-12))}
+
+# Train LDA with the given number of topics on the first num_train documents (in a worker
+# process). The other documents are held out to compute the perplexity
+def train_lda(work_path, topics, num_train, num_docs, passes, alpha, queries):
+    dictionary = Dictionary.load(os.path.join(work_path, "corpus.dict"))
+    log_entropy = LogEntropyModel.load(os.path.join(work_path, "sweep_logentropy.model"))
+    documents = Documents(os.path.join(work_path, "sweep_weighed_corpus.mm"), 0, num_train)
+
+    t_init = time.perf_counter()
+    lda = LdaModel(documents, topics, dictionary, passes=passes, alpha=alpha)
+    train_s = time.perf_counter() - t_init
+
+    model_path = os.path.join(work_path, "sweep", "lda_{}".format(topics))
+    os.makedirs(model_path, exist_ok=True)
+    lda.save(os.path.join(model_path, "lda.model"), sep_limit=SEPARATE_ARRAY_SIZE)
+
+    # As SimilarityModel.document_map, for a query string
+    embed = lambda query: lda.get_document_topics(log_entropy[dictionary.doc2bow(preprocess_string(query))], minimum_probability=0.0)
+
+    held_out = list(Documents(os.path.join(work_path, "sweep_weighed_corpus.mm"), num_train, num_docs))
+    coherence = CoherenceModel(model=lda, corpus=Documents(os.path.join(work_path, "corpus.mm"), 0, num_train),
+                               dictionary=dictionary, coherence="u_mass")
+
+    return {"model": "lda", "size": topics, "train_s": train_s, "model_bytes": _size(model_path),
+            "query": summarize(measure(embed, [(query,) for query in queries])),
+            "coherence": float(coherence.get_coherence()),
+            "perplexity": float(np.exp2(-lda.log_perplexity(held_out))) if held_out else None}
+
+# Total size of the files in a directory
+def _size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+def report(res):
+    quality = "energy {:.3f}".format(res["energy"]) if res["model"] == "lsi" else \
+              "coherence {:.3f}  perplexity {}".format(res["coherence"], "-" if res["perplexity"] is None else "{:.1f}".format(res["perplexity"]))
+    print("{} {:>4}  train {:>8.1f} s  size {:>10.1f} KiB  query p50 {:>7.3f} ms  p95 {:>7.3f} ms  {}".format(
+        res["model"].upper(), res["size"], res["train_s"], res["model_bytes"] / 1024, res["query"]["p50_ms"],
+        res["query"]["p95_ms"], quality), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and compare models with different numbers of LSI dimensions and LDA topics")
+    parser.add_argument("-text", "--text-path", help="Path to directory containing text files", required=True)
+    parser.add_argument("--work-dir", help="Directory for the corpus cache and the trained models (e.g. the model directory, to reuse its corpus cache)", required=True)
+    parser.add_argument("--lsi", help="Comma-separated numbers of LSI dimensions", default="10,25,50,100")
+    parser.add_argument("--lda", help="Comma-separated numbers of LDA topics", default="10,20,40")
+    parser.add_argument("--passes", help="Number of LDA training passes", default=5, type=int)
+    parser.add_argument("--lda-alpha", help="LDA document-topic prior", default="auto", choices=["auto", "symmetric", "asymmetric"])
+    parser.add_argument("--holdout", help="Share of the documents held out from LDA training to compute the perplexity", default=0.1, type=float)
+    parser.add_argument("--queries", help="Number of query strings embedded to time each model", default=200, type=int)
+    parser.add_argument("-w", "--workers", help="Number of models trained at once (default: one per CPU core)", default=None, type=int)
+    parser.add_argument("--seed", help="Random seed of the query strings", default=0, type=int)
+    parser.add_argument("-o", "--output", help="JSON file the results are written to", default="sweep.json")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    t_init = time.perf_counter()
+    num_docs, energy = prepare(args.text_path, args.work_dir)
+    print("\nCorpus of {} documents ready in {:.1f} s\n".format(num_docs, time.perf_counter() - t_init))
+
+    # Query strings made of random words of the corpus
+    rng = np.random.default_rng(args.seed)
+    words = list(Dictionary.load(os.path.join(args.work_dir, "corpus.dict")).token2id)
+    queries = [" ".join(rng.choice(words, 3)) for _ in range(args.queries)] if words else [""]
+    num_train = num_docs - int(num_docs * args.holdout)
+
+    results = {"meta": {"args": vars(args), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "documents": num_docs,
+                        "cpus": os.cpu_count()},
+               "lsi": {}, "lda": {}}
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [pool.submit(train_lsi, args.work_dir, int(dims), num_docs, energy, queries) for dims in args.lsi.split(",")]
+        jobs += [pool.submit(train_lda, args.work_dir, int(topics), num_train, num_docs, args.passes, args.lda_alpha, queries)
+                 for topics in args.lda.split(",")]
+        for job in as_completed(jobs):
+            res = job.result()
+            results[res["model"]][str(res["size"])] = res
+            report(res)
+
+    results["meta"]["total_s"] = time.perf_counter() - t_init
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("\nSweep done in {:.1f} s, results written to {}\n".format(results["meta"]["total_s"], args.output))
+
+if __name__ == "__main__":
+    main()
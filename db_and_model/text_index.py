@@ -0,0 +1,55 @@
+import numpy as np
+
+class NgramIndex:
+    '''
+
+    In-process n-gram inverted index for case-insensitive substring and prefix search.
+
+    Every lower-cased string is split into overlapping n-grams; each n-gram maps to the sorted
+    rows containing it. A query is answered by intersecting the posting lists of its n-grams,
+    then checking the few remaining candidates.
+
+    '''
+    def __init__(self, n=3):
+        self.n = n
+        self.ids = np.empty(0, dtype=np.int64)
+        self.strings = []
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def build(self, ids, strings):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.strings = [(string or "").lower() for string in strings]
+
+        postings = {}
+        for row, string in enumerate(self.strings):
+            for gram in self._grams(string):
+                postings.setdefault(gram, []).append(row)
+
+        self.postings = {gram: np.array(rows, dtype=np.int64) for gram, rows in postings.items()}
+
+    # Return the ids whose string contains (or starts with, if prefix) the query, case-insensitive
+    def search(self, query, prefix=False):
+        query = query.lower()
+        grams = self._grams(query)
+
+        if grams:
+            lists = sorted((self.postings.get(gram) for gram in grams), key=lambda rows: 0 if rows is None else len(rows))
+            if lists[0] is None:
+                return []
+            candidates = lists[0]
+            for rows in lists[1:]:
+                candidates = np.intersect1d(candidates, rows, assume_unique=True)
+                if len(candidates) == 0:
+                    return []
+        else: # Query shorter than n, check every string
+            candidates = range(len(self.strings))
+
+        if prefix:
+            return [int(self.ids[row]) for row in candidates if self.strings[row].startswith(query)]
+        return [int(self.ids[row]) for row in candidates if query in self.strings[row]]
+
+    def _grams(self, string):
+        return {string[i:i + self.n] for i in range(len(string) - self.n + 1)}
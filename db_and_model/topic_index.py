@@ -0,0 +1,57 @@
+import numpy as np
+
+class TopicIndex:
+    '''
+
+    Per-topic posting lists: for every LDA topic, the papers with a non-zero probability for it,
+    sorted by decreasing probability. Stored compactly as one array of rows (int32 indices into
+    the paper ids) and one of float32 probabilities, with the list of topic t between
+    offsets[t] and offsets[t + 1]. A page of a list is an array slice.
+
+    '''
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.rows = np.empty(0, dtype=np.int32)
+        self.probs = np.empty(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_topics(self):
+        return len(self.offsets) - 1
+
+    # ids: paper ids; topic_probs: one row of topic probabilities per paper; num_topics: number
+    # of (empty) lists when there are no papers
+    def build(self, ids, topic_probs, num_topics=0):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        if len(self.ids) > 0:
+            topic_probs = np.asarray(topic_probs, dtype=np.float32).reshape(len(self.ids), -1)
+        else:
+            topic_probs = np.zeros((0, num_topics), dtype=np.float32)
+
+        rows = []
+        probs = []
+        for topic in range(topic_probs.shape[1]):
+            column = topic_probs[:, topic]
+            found = np.flatnonzero(column > 0)
+            order = found[np.argsort(-column[found], kind="stable")]
+            rows.append(order.astype(np.int32))
+            probs.append(column[order])
+
+        self.offsets = np.concatenate(([0], np.cumsum([len(r) for r in rows]))).astype(np.int64)
+        self.rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int32)
+        self.probs = np.concatenate(probs) if probs else np.empty(0, dtype=np.float32)
+
+    # Number of papers in the posting list of a topic
+    def count(self, topic):
+        return int(self.offsets[topic + 1] - self.offsets[topic])
+
+    # Paper ids and probabilities at ranks [start, start + limit) of the posting list of a topic
+    def page(self, topic, start=0, limit=None):
+        begin = self.offsets[topic] + start
+        end = self.offsets[topic + 1] if limit is None else min(begin + limit, self.offsets[topic + 1])
+        if begin >= end:
+            return [], []
+        return self.ids[self.rows[begin:end]].tolist(), self.probs[begin:end].tolist()
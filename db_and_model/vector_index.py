@@ -0,0 +1,139 @@
+import numpy as np
+
+class VectorIndex:
+    '''
+
+    In-process cosine similarity index over the paper coordinate vectors.
+
+    mode: 'exact' - blocked matrix multiply over every vector plus argpartition
+          'approx' - inverted file (IVF) index, only the `nprobe` closest lists are scanned
+
+    '''
+    def __init__(self, mode="exact", block_size=65536, num_lists=None, nprobe=8, seed=0):
+        if mode not in ("exact", "approx"):
+            raise ValueError("Search mode not supported: {}".format(mode))
+
+        self.mode = mode
+        self.block_size = block_size # Number of rows scored per matrix multiply
+        self.num_lists = num_lists # Number of IVF lists (defaults to ~sqrt(N))
+        self.nprobe = nprobe # Number of IVF lists scanned per query (recall/latency knob)
+        self.seed = seed
+        self.ids = np.empty(0, dtype=np.int64)
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.centroids = None
+        self.list_offsets = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Build the index from paper ids and their (unnormalized) coordinate vectors
+    def build(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        matrix = normalize(vectors)
+
+        if self.mode == "approx" and len(ids) > 0:
+            assignments = self._train_lists(matrix)
+            # Reorder rows so that each inverted list is a contiguous slice of the matrix
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=len(self.centroids))
+            self.list_offsets = np.concatenate(([0], np.cumsum(counts)))
+            ids = ids[order]
+            matrix = matrix[order]
+
+        self.ids = ids
+        self.matrix = np.ascontiguousarray(matrix)
+
+    # Return the ids and cosine similarities of the K nearest vectors for each query
+    # queries: single vector or matrix with one query per row
+    def search(self, queries, K, nprobe=None):
+        queries = normalize(np.atleast_2d(queries))
+        K = min(K, len(self.ids))
+
+        if K == 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+
+        if self.mode == "approx":
+            return self._search_lists(queries, K, self.nprobe if nprobe is None else nprobe)
+
+        rows, scores = top_k(queries, self.matrix, K, self.block_size)
+        return self.ids[rows], scores
+
+    # Spherical k-means over (a sample of) the normalized vectors. Returns the list of each row
+    def _train_lists(self, matrix, iterations=10, sample_size=100000):
+        num_lists = self.num_lists or max(1, int(np.sqrt(len(matrix))))
+        num_lists = min(num_lists, len(matrix))
+        rng = np.random.default_rng(self.seed)
+
+        sample = matrix
+        if len(matrix) > sample_size:
+            sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = self._assign(sample, centroids)
+            for c in range(num_lists):
+                members = sample[assignments == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+            centroids = normalize(centroids)
+
+        self.centroids = centroids
+        return self._assign(matrix, centroids)
+
+    def _assign(self, matrix, centroids):
+        assignments = np.empty(len(matrix), dtype=np.int64)
+        for start in range(0, len(matrix), self.block_size):
+            block = matrix[start:start + self.block_size]
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return assignments
+
+    def _search_lists(self, queries, K, nprobe):
+        nprobe = min(nprobe, len(self.centroids))
+        probe_lists, _ = top_k(queries, self.centroids, nprobe, self.block_size)
+
+        ids = np.full((len(queries), K), -1, dtype=np.int64)
+        scores = np.full((len(queries), K), -np.inf, dtype=np.float32)
+
+        for q, lists in enumerate(probe_lists):
+            rows = np.concatenate([np.arange(self.list_offsets[l], self.list_offsets[l + 1]) for l in lists])
+            if len(rows) == 0:
+                continue
+            k = min(K, len(rows))
+            best, best_scores = top_k(queries[q:q + 1], self.matrix[rows], k, self.block_size)
+            ids[q, :k] = self.ids[rows[best[0]]]
+            scores[q, :k] = best_scores[0]
+
+        return ids, scores
+
+# Scale rows to unit length (zero rows are left untouched)
+def normalize(vectors):
+    matrix = np.atleast_2d(np.asarray(vectors, dtype=np.float32)) # No copy of float32 arrays, e.g. memory maps
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+# Exact top-K by inner product, computed block by block so that only a
+# (queries x block_size) score matrix is ever held in memory.
+# Returns row indices into `matrix` and scores, both sorted by descending score
+def top_k(queries, matrix, K, block_size=65536):
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+
+    for start in range(0, len(matrix), block_size):
+        block_scores = queries @ matrix[start:start + block_size].T
+        k = min(K, block_scores.shape[1])
+        # Highest k scores are the last k after partitioning (no negated copy of the block)
+        part = np.argpartition(block_scores, block_scores.shape[1] - k, axis=1)[:, -k:]
+
+        best_rows = np.concatenate((best_rows, part + start), axis=1)
+        best_scores = np.concatenate((best_scores, np.take_along_axis(block_scores, part, axis=1)), axis=1)
+
+        # Keep only the running top-K candidates between blocks
+        if best_rows.shape[1] > K:
+            part = np.argpartition(-best_scores, K - 1, axis=1)[:, :K]
+            best_rows = np.take_along_axis(best_rows, part, axis=1)
+            best_scores = np.take_along_axis(best_scores, part, axis=1)
+
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
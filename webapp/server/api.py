@@ -1,19 +1,23 @@
 '''
 App backend API
 '''
+import time
+t_start = time.perf_counter() # Startup time, including imports, is reported once the server is ready
 import argparse
 import atexit
 from pathlib import Path
 import urllib.parse
-from flask import Flask, jsonify, request, redirect, make_response
+from flask import Flask, Response, g, jsonify, request, redirect, send_file
 from flask_cors import CORS
 import numpy as np
-from sklearn.manifold import TSNE
 import database
+from layout import LayoutCache, pca_layout, tsne_layout
+import metrics
+from json_response import json_response
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-m", "--model-path", help="Path to directory containing saved topic modelling files", required=True)
-parser.add_argument("-r", "--db-uri", help="Database URI", default="bolt://localhost:7687")
+parser.add_argument("-r", "--db-uri", help="Database URI: bolt://<host>:<port> (Neo4j server), embedded://<directory> (SQLite and memory-mapped files, no server) or memory:// (in-process, not persisted)", default="bolt://localhost:7687")
 parser.add_argument("-u", "--user", help="Database account username", default="neo4j")
 parser.add_argument("-p", "--password", help="Database account password", default="capstone")
 parser.add_argument("-k", "--neighbours", help="Number of neighbours in knn graph", default=25, type=int)
@@ -23,13 +27,68 @@ parser.add_argument("-pdf", "--pdf-path", help="Path to directory containing pdf
 parser.add_argument("-text", "--text-path", help="Path to directory containing text files", default="")
 parser.add_argument("-t", "--train", help="Train the model from scratch. True/False", default=False, action="store_true")
 parser.add_argument("-n", "--nodes", help="Rebuild database nodes. True/False", default=False, action="store_true")
+parser.add_argument("-i", "--incremental", help="Add new PDFs to the existing database without rebuilding it. With --train, update the LDA model online instead of retraining (the LSI model is kept so that stored coordinates stay valid)", default=False, action="store_true")
 parser.add_argument("-c", "--convert", help="Convert PDFs to text files", default=False, action="store_true")
+parser.add_argument("-s", "--search-mode", help="Topic search index mode", default="exact", choices=["exact", "approx"])
+parser.add_argument("--nprobe", help="Number of index lists scanned per topic query in approx search mode", default=8, type=int)
+parser.add_argument("--batch-size", help="Number of papers written per database transaction when building nodes", default=1000, type=int)
+parser.add_argument("--writers", help="Number of concurrent database writer sessions when building nodes", default=1, type=int)
+parser.add_argument("-w", "--workers", help="Number of workers for PDF conversion, LDA training and document projection (default: one per CPU core)", default=None, type=int)
+parser.add_argument("--train-chunksize", help="Number of documents per LSI/LDA training chunk (default: gensim defaults, 20000 for LSI and 2000 for LDA)", default=None, type=int)
+parser.add_argument("--lda-alpha", help="LDA document-topic prior. 'auto' (learned) is only supported by single-process training, the others train LDA on --workers processes", default="auto", choices=["auto", "symmetric", "asymmetric"])
+parser.add_argument("--layout", help="Visualization layout: precomputed global layout, cached per-paper t-SNE, or PCA", default="global", choices=["global", "local", "pca"])
+parser.add_argument("--layout-method", help="Method for the global layout computed when building nodes", default="tsne", choices=["tsne", "pca"])
+parser.add_argument("--layout-cache-size", help="Number of per-paper layouts cached in local layout mode", default=1024, type=int)
+parser.add_argument("--cache-size", help="Maximum number of cached search results (0 to disable the cache)", default=1024, type=int)
+parser.add_argument("--cache-ttl", help="Seconds before a cached search result expires", default=300, type=float)
+parser.add_argument("--text-index", help="Author/title search backend: database property indexes or in-process n-gram index", default="neo4j", choices=["neo4j", "ngram"])
+parser.add_argument("--pdf-max-age", help="Seconds browsers may cache served PDFs before revalidating", default=3600, type=int)
+parser.add_argument("--related-index", help="Related-paper queries: KNN graph loaded in memory at startup, or traversed in the database", default="memory", choices=["memory", "db"])
+parser.add_argument("--knn-backend", help="KNN graph builder: GDS procedure in the database or native Python builder", default="gds", choices=["gds", "native"])
+parser.add_argument("--knn-mode", help="Exact or approximate neighbours for the native KNN graph builder", default="exact", choices=["exact", "approx"])
+parser.add_argument("--knn-recall", help="Report the recall of the native KNN graph against GDS (requires the GDS plugin)", default=False, action="store_true")
+parser.add_argument("--server", help="Serving mode: Flask development server or ASGI server (uvicorn) with bounded request pools", default="flask", choices=["flask", "asgi"])
+parser.add_argument("--host", help="Address the server listens on", default="127.0.0.1")
+parser.add_argument("--port", help="Port the server listens on", default=5000, type=int)
+parser.add_argument("--cpu-workers", help="ASGI mode: threads serving CPU-bound requests (topic search, visualization)", default=4, type=int)
+parser.add_argument("--io-workers", help="ASGI mode: threads serving the other requests", default=16, type=int)
+parser.add_argument("--max-queue", help="ASGI mode: requests that may wait for a thread in each pool before new ones get 503", default=64, type=int)
+parser.add_argument("--request-timeout", help="ASGI mode: seconds before a request gets 504", default=30, type=float)
+parser.add_argument("--max-batch-size", help="Maximum number of topic strings in one /search/batch request", default=10000, type=int)
+parser.add_argument("--fast-start", help="Memory-map the saved model and load each of its parts on first use instead of at startup", default=False, action="store_true")
+parser.add_argument("--compress-min-size", help="Minimum size in bytes of the JSON responses compressed (brotli or gzip) for clients that accept it", default=1024, type=int)
+parser.add_argument("--stream-min-items", help="Minimum number of results of the JSON responses streamed a block of results at a time", default=1000, type=int)
+parser.add_argument("--pool-size", help="Maximum number of Neo4j connections", default=100, type=int)
+parser.add_argument("--pool-timeout", help="Seconds a query waits for a free Neo4j connection before failing", default=60, type=float)
+parser.add_argument("--pool-lifetime", help="Seconds before a Neo4j connection is closed and replaced", default=3600, type=float)
+parser.add_argument("--warm-up", help="Number of database connections opened at startup (default: --cpu-workers + --io-workers in ASGI mode, 1 otherwise)", default=None, type=int)
 parser.add_argument("-d", "--debug", help="Turn debug mode on or off. True/False", default=False, action="store_true")
 args = parser.parse_args()
 
 app = Flask(__name__)
 CORS(app)
 
+layout_cache = LayoutCache(args.layout_cache_size)
+
+@app.before_request
+def start_timer():
+    g.t_request = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    # Labelled by route pattern (e.g. /visualization/<paper_id>), not by URL
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if "t_request" in g:
+        metrics.observe("route", route, time.perf_counter() - g.t_request)
+    return response
+
+def to_json(res):
+    '''
+    JSON response, compressed if the client accepts it and streamed for long result lists (see
+    json_response), timed as the json_serialization and compression stages
+    '''
+    return json_response(res, request.headers.get("Accept-Encoding", ""), args.compress_min_size, args.stream_min_items)
+
 @app.route('/')
 def home():
     return redirect('/search'), 301
@@ -39,53 +98,166 @@ def search():
     '''
     Main search route. Looks for URL query string "author", "title", "id", or "topic". If querying
     by author, title, or id, also requires additional query string "mode" as "exact" or "related".
+    Author and title searches are case-insensitive substring matches, or prefix matches with the
+    optional query string "match=prefix".
+
+    Optional query strings:
+      fields: comma-separated paper properties to return (default: all), e.g. "title,author,year"
+      limit: page size for author, title and id searches. The response is then an object with the
+        page of "results" and the "next_cursor" to pass as "cursor" for the next page (null on the
+        last page)
+      cursor: "next_cursor" of the previous page
+      hops: for related searches, also return the papers up to this many neighbour steps away (default: 1)
 
     Search examples:
       author: http://localhost:5000/search?author=Jane%20Doe%201000&mode=exact
       title: http://localhost:5000/search?title=Phasor%20Neural%20Networks&mode=exact
+      title prefix: http://localhost:5000/search?title=phasor&mode=exact&match=prefix
       id: http://localhost:5000/search?id=0&mode=exact
       topic: http://localhost:5000/search?topic=reinforcement%20learning
+      paged: http://localhost:5000/search?author=Jane%20Doe&mode=exact&fields=title,year&limit=50
+      two hops: http://localhost:5000/search?id=0&mode=related&hops=2
     '''
     author = request.args.get('author')
     title = request.args.get('title')
     paper_id = request.args.get('id')
     topic = request.args.get('topic')
     mode = request.args.get('mode')
+    match = request.args.get('match', 'contains')
+
+    if match not in ('contains', 'prefix'):
+        return jsonify("[ERROR]: 'match' query string must be 'contains' or 'prefix'"), 400
+
+    try:
+        fields, cursor, limit = page_args()
+    except ValueError as err:
+        return jsonify("[ERROR]: {}".format(err)), 400
+
+    try:
+        hops = int(request.args.get('hops', 1))
+    except ValueError:
+        hops = 0
+    if hops < 1:
+        return jsonify("[ERROR]: 'hops' query string must be a positive integer"), 400
 
     if author:
         if not mode:
             return jsonify("[ERROR]: 'mode' query string required for author search"), 400
-        res = db.query_by_author(author, mode)
-
-        if args.debug:
-            res, query_time = res
+        res = db.query_by_author(author, mode, match, fields, cursor, limit, hops)
 
     elif title:
         if not mode:
             return jsonify("[ERROR]: 'mode' query string required for title search"), 400
-        res = db.query_by_title(title, mode)
-
-        if args.debug:
-            res, query_time = res
+        res = db.query_by_title(title, mode, match, fields, cursor, limit, hops)
 
     elif paper_id:
         if not mode:
             return jsonify("[ERROR]: 'mode' query string required for id search"), 400
-        res = db.query_by_paper_id(int(paper_id), mode)
-
-        if args.debug:
-            res, query_time = res
+        res = db.query_by_paper_id(int(paper_id), mode, fields, cursor, limit, hops)
 
     elif topic:
-        res = db.query_by_string(topic)
-
-        if args.debug:
-            res, query_time = res
+        res = db.query_by_string(topic, fields)
 
     else:
         return jsonify("[ERROR]: missing or incorrect URL query arguments"), 400
 
-    return jsonify(res)
+    if limit is not None and not topic:
+        next_cursor = res[-1]["paper_id"] if res and len(res) == limit else None
+        return to_json({"results": res, "next_cursor": next_cursor})
+
+    return to_json(res)
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    '''
+    Topic search for many strings in one request. The body is a JSON object with the list of
+    "topics"; the strings are embedded and scored together and their papers fetched with one
+    database query. Returns one list of papers per string, in the same order.
+
+    Optional query string:
+      fields: comma-separated paper properties to return (default: all)
+
+    Example: curl -X POST "http://localhost:5000/search/batch?fields=title" -H "Content-Type: application/json"
+                  -d '{"topics": ["reinforcement learning", "graph neural networks"]}'
+    '''
+    body = request.get_json(silent=True)
+    topics = body.get("topics") if isinstance(body, dict) else None
+    if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+        return jsonify("[ERROR]: request body must be a JSON object with a list of strings 'topics'"), 400
+    if len(topics) > args.max_batch_size:
+        return jsonify("[ERROR]: at most {} topics per request".format(args.max_batch_size)), 400
+
+    try:
+        fields, _, _ = page_args()
+    except ValueError as err:
+        return jsonify("[ERROR]: {}".format(err)), 400
+
+    return to_json(db.query_by_strings(topics, fields))
+
+def page_args():
+    '''
+    Parse the optional "fields", "cursor" and "limit" query strings. Raises ValueError if invalid
+
+    Returns:
+        fields: list of paper properties, or None for all
+        cursor: int or None
+        limit: positive int or None
+    '''
+    fields = request.args.get('fields')
+    if fields:
+        fields = fields.split(',')
+        unknown = [field for field in fields if field not in database.PAPER_FIELDS]
+        if unknown:
+            raise ValueError("unknown fields: {}".format(", ".join(unknown)))
+    else:
+        fields = None
+
+    try:
+        limit = request.args.get('limit')
+        limit = int(limit) if limit else None
+        cursor = request.args.get('cursor')
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        raise ValueError("'limit' and 'cursor' must be integers")
+    if limit is not None and limit <= 0:
+        raise ValueError("'limit' must be positive")
+
+    return fields, cursor, limit
+
+@app.route('/topic/<topic_id>')
+def topic(topic_id):
+    '''
+    Papers of an LDA topic ranked by decreasing probability for it, one page at a time. Pages
+    are slices of a ranking precomputed when the server starts.
+
+    Optional query strings:
+      fields: comma-separated paper properties to return (default: all)
+      limit: page size (default: number of neighbours in the knn graph)
+      cursor: "next_cursor" of the previous page (the number of papers already returned)
+
+    Returns {"results": [...], "next_cursor": <N>} ("next_cursor" is null on the last page)
+
+    Example: http://localhost:5000/topic/3?fields=title,year&limit=20&cursor=40
+    '''
+    try:
+        topic_id = int(topic_id)
+    except ValueError:
+        return jsonify("[ERROR]: topic id must be an integer"), 400
+    if not 0 <= topic_id < db.topic_index.num_topics:
+        return jsonify("[ERROR]: topic id must be between 0 and {}".format(db.topic_index.num_topics - 1)), 400
+
+    try:
+        fields, cursor, limit = page_args()
+    except ValueError as err:
+        return jsonify("[ERROR]: {}".format(err)), 400
+    if cursor is not None and cursor < 0:
+        return jsonify("[ERROR]: 'cursor' must not be negative"), 400
+
+    res = db.query_by_topic_index(topic_id, fields, cursor, limit)
+    start = cursor or 0
+    page_size = db.numK if limit is None else limit
+    next_cursor = start + len(res) if len(res) == page_size and start + len(res) < db.topic_index.count(topic_id) else None
+    return to_json({"results": res, "next_cursor": next_cursor})
 
 @app.route('/article/pdf_by_path/<pdf_path>')
 def article_pdf_by_path(pdf_path):
@@ -104,16 +276,10 @@ def article_pdf_by_path(pdf_path):
         pdf_path = pdf_path.replace("\\","/")
 
     try:
-        with open(pdf_path, "rb") as pdf:
-            pdf_bytes = pdf.read()
+        return send_pdf(pdf_path, title)
     except Exception as err:
         return jsonify("[ERROR]: {}".format(err)), 400
 
-    res = make_response(pdf_bytes)
-    res.headers['Content-Type'] = 'application/pdf'
-    res.headers['Content-Disposition'] = 'inline; filename={}.pdf'.format(title)
-    return res
-
 @app.route('/article/pdf_by_id/<paper_id>')
 def article_pdf_by_id(paper_id):
     '''
@@ -123,55 +289,99 @@ def article_pdf_by_id(paper_id):
     Example: http://localhost:5000/article/pdf_by_id/Phasor_Neural_Networks
     '''
     db_res = db.query_by_paper_id(int(paper_id), "exact")
-    if args.debug:
-        db_res, query_time = db_res
 
     if not db_res:
         return jsonify("[ERROR]: could not find paper_id ({}) in database".format(paper_id)), 400
 
-    with open(db_res[0]["pdf"], "rb") as pdf:
-        pdf_bytes = pdf.read()
-    res = make_response(pdf_bytes)
-    res.headers['Content-Type'] = 'application/pdf'
-    res.headers['Content-Disposition'] = 'inline; filename={}.pdf'.format(db_res[0]["title"])
-    return res
+    return send_pdf(db_res[0]["pdf"], db_res[0]["title"])
+
+def send_pdf(pdf_path, title):
+    '''
+    Stream a PDF file inline without reading it into memory. The file is sent in chunks (with
+    sendfile when the server supports it), with ETag / Last-Modified headers for browser caching.
+    Conditional requests get 304 Not Modified and Range requests get 206 Partial Content.
+
+    Parameters:
+        pdf_path: File system path to PDF file
+        title: Title used for the file name
+    '''
+    if not Path(pdf_path).is_file():
+        raise FileNotFoundError("No such file: '{}'".format(pdf_path))
+
+    return send_file(pdf_path, mimetype='application/pdf', download_name='{}.pdf'.format(title),
+                     conditional=True, etag=True, max_age=args.pdf_max_age)
 
 @app.route('/visualization/<paper_id>')
 def visualization(paper_id):
-    itself = db.query_by_paper_id(int(paper_id), "exact")
-    related = db.query_by_paper_id(int(paper_id), "related")
-    if args.debug:
-        itself, query_time = itself
-        related, query_time = related
+    '''
+    2D layout of a paper and its nearest neighbours, relative to the paper itself.
+
+    Layout modes (--layout):
+      global: layout of the whole archive computed when the database was built
+      local: t-SNE of the paper and its neighbours, cached per paper
+      pca: projection of the paper and its neighbours onto their first two principal components
+    '''
+    with db.session():
+        itself = db.query_by_paper_id(int(paper_id), "exact")
+        related = db.query_by_paper_id(int(paper_id), "related")
     knn = itself + related
 
-    coords = []
-    for paper in knn:
-        coords.append(paper["coord"])
-    coords_numpy = np.array(coords)
-    transformed = TSNE(n_components = 2).fit_transform(coords_numpy)
-    offset=transformed[0].tolist()
+    layout = None
+    if args.layout == "global" and all(paper.get("layout") is not None for paper in knn):
+        layout = np.array([paper["layout"] for paper in knn])
+    elif args.layout == "local" and len(knn) >= 3: # t-SNE needs at least 3 points
+        layout = layout_cache.get(int(paper_id))
+        if layout is None or len(layout) != len(knn):
+            layout = tsne_layout([paper["coord"] for paper in knn])
+            layout_cache.put(int(paper_id), layout)
+
+    # Fall back to PCA (e.g. database built before layouts were stored, or too few papers for t-SNE)
+    if layout is None:
+        layout = pca_layout([paper["coord"] for paper in knn])
+
+    if len(knn):
+        layout = layout - layout[0]
     for i, paper in enumerate(knn):
-        pc =  transformed[i].tolist()
-        pc[0]=pc[0]-offset[0]
-        pc[1]=pc[1]-offset[1]
-        paper["processed_coord"] = pc
+        paper["processed_coord"] = layout[i].tolist()
 
-    return jsonify(knn)
+    return to_json(knn)
+
+@app.route('/metrics')
+def metrics_route():
+    '''
+    Latency histograms per query stage, DbDriver call and route, query cache and database
+    connection pool counters, startup time and resident memory, in the Prometheus text format
+    '''
+    # Cumulative counts are counters, the current and maximum sizes gauges
+    cumulative = ("hits", "misses", "evictions", "invalidations", "sessions_opened")
+    gauges = []
+    counters = []
+    for prefix, help, stats in (("infera_query_cache", "Query cache", db.query_cache.stats()),
+                                ("infera_db_pool", "Database connection pool", db.pool_stats())):
+        for name, value in stats.items():
+            if name in cumulative:
+                counters.append(("{}_{}_total".format(prefix, name), "{} {}".format(help, name.replace("_", " ")), value))
+            else:
+                gauges.append(("{}_{}".format(prefix, name), "{} {}".format(help, name.replace("_", " ")), value))
+    gauges.append(("infera_startup_seconds", "Time from process start until the server was ready", startup_seconds))
+    memory = metrics.resident_memory()
+    if memory is not None:
+        gauges.append(("infera_resident_memory_bytes", "Resident memory of the server process", memory))
+    return Response(metrics.render(gauges, counters), mimetype="text/plain; version=0.0.4")
 
 @app.route('/topicwords/<topic_id>')
 def topic_terms(topic_id):
     topic_id=int(topic_id)
     if topic_id != -1:
-        return jsonify(db.topic_terms[topic_id])
+        return to_json(db.topic_terms[topic_id])
     else:
-        return jsonify(db.topic_terms)
+        return to_json(db.topic_terms)
 
 if __name__ == "__main__":
-    if not args.pdf_path and (args.nodes or args.convert):
-        raise RuntimeError("PDF path required `-pdf <path>` for options --nodes / --convert")
-    if not args.text_path and (args.train or args.convert):
-        raise RuntimeError("Text path required `-text <path>` for options --train / --convert")
+    if not args.pdf_path and (args.nodes or args.convert or args.incremental):
+        raise RuntimeError("PDF path required `-pdf <path>` for options --nodes / --convert / --incremental")
+    if not args.text_path and (args.train or args.convert or args.incremental):
+        raise RuntimeError("Text path required `-text <path>` for options --train / --convert / --incremental")
 
     # persistent connection to database at app start
     db = database.get_db(
@@ -187,11 +397,41 @@ if __name__ == "__main__":
         debug_info=args.debug,
         train_model=args.train,
         build_nodes=args.nodes,
-        convert_pdfs=args.convert
+        convert_pdfs=args.convert,
+        search_mode=args.search_mode,
+        nprobe=args.nprobe,
+        batch_size=args.batch_size,
+        writers=args.writers,
+        workers=args.workers,
+        layout_method=args.layout_method,
+        cache_size=args.cache_size,
+        cache_ttl=args.cache_ttl,
+        text_index=args.text_index,
+        incremental=args.incremental,
+        knn_backend=args.knn_backend,
+        knn_mode=args.knn_mode,
+        knn_recall=args.knn_recall,
+        fast_start=args.fast_start,
+        train_chunksize=args.train_chunksize,
+        lda_alpha=args.lda_alpha,
+        pool_size=args.pool_size,
+        pool_timeout=args.pool_timeout,
+        pool_lifetime=args.pool_lifetime,
+        warm_up=args.warm_up if args.warm_up is not None else (args.cpu_workers + args.io_workers if args.server == "asgi" else 1),
+        related_index=args.related_index
     )
 
     # close database connection at app exit
     atexit.register(database.close_db, db)
 
+    # report how long the server took to get ready and how much memory it holds
+    startup_seconds = time.perf_counter() - t_start
+    memory = metrics.resident_memory()
+    print("[INFO]: Ready in {:.2f} s, resident memory {}".format(startup_seconds, "{:.0f} MiB".format(memory / 2**20) if memory is not None else "unknown"))
+
     # start app
-    app.run(debug=args.debug)
+    if args.server == "asgi":
+        import asgi
+        asgi.serve(app, args.host, args.port, args.cpu_workers, args.io_workers, args.max_queue, args.request_timeout)
+    else:
+        app.run(host=args.host, port=args.port, debug=args.debug)
@@ -0,0 +1,211 @@
+'''
+ASGI serving mode
+
+Serves the Flask app from an asyncio server (uvicorn) instead of the Flask development server.
+Each request runs on one of two bounded thread pools: CPU-bound routes (topic search and batch
+topic search, which project the queries through the model, and visualization, which may compute
+a t-SNE layout) and everything else (database lookups, PDF files). A slow visualization can then only hold CPU
+workers, while searches keep being served by the other pool.
+
+Each pool accepts at most `workers + max_queue` requests at once. Past that, new requests get
+503 Service Unavailable with a Retry-After header right away instead of queuing without bound,
+and requests that take longer than the timeout get 504 Gateway Timeout.
+'''
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Minimum size of the body chunks sent to the client (streamed bodies, e.g. PDFs, are read in blocks)
+CHUNK_SIZE = 65536
+
+class RequestPool:
+    '''
+
+    Thread pool running at most `workers` requests at once, with at most `max_queue` more
+    waiting for a worker
+
+    '''
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.pending = 0 # Requests running or waiting (only changed from the event loop thread)
+        self.rejected = 0
+
+    # Reserve a place for a request, False if the pool is full
+    def admit(self):
+        if self.pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+class AsgiServer:
+    '''
+
+    ASGI application running a WSGI (Flask) app on bounded request pools
+
+    app: WSGI application
+    cpu_workers, io_workers: number of threads of the CPU-bound and of the other request pool
+    max_queue: number of requests that may wait for a thread in each pool
+    timeout: seconds before a request is answered with 504 (None: no timeout)
+
+    '''
+    def __init__(self, app, cpu_workers=4, io_workers=16, max_queue=64, timeout=30):
+        self.app = app
+        self.pools = {"cpu": RequestPool("cpu", cpu_workers, max_queue), "io": RequestPool("io", io_workers, max_queue)}
+        self.timeout = timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    # Pool for a request: topic searches and visualizations are CPU-bound
+    @staticmethod
+    def pool_name(path, query_string):
+        if path.startswith("/visualization/") or path == "/search/batch":
+            return "cpu"
+        if path == "/search" and any(arg.split(b"=")[0] == b"topic" for arg in query_string.split(b"&")):
+            return "cpu"
+        return "io"
+
+    async def _http(self, scope, receive, send):
+        pool = self.pools[self.pool_name(scope["path"], scope["query_string"])]
+        if not pool.admit():
+            await self._error(send, 503, "[ERROR]: server busy ({} requests pending), retry later".format(pool.name),
+                              [(b"retry-after", b"1")])
+            return
+
+        loop = asyncio.get_running_loop()
+        release = True
+        try:
+            body = await self._read_body(receive)
+            future = pool.executor.submit(run_wsgi, self.app, wsgi_environ(scope, body))
+            try:
+                status, headers, chunk, chunks, response = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+            except asyncio.TimeoutError:
+                # The request keeps its place in the pool until its thread is done
+                release = False
+                future.add_done_callback(lambda _: loop.call_soon_threadsafe(pool.release))
+                await self._error(send, 504, "[ERROR]: request timed out after {} s".format(self.timeout))
+                return
+
+            await send({"type": "http.response.start", "status": int(status.split(" ", 1)[0]),
+                        "headers": [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in headers]})
+
+            # The first chunk was read with the response, the rest is read in the pool as it is sent
+            try:
+                if not chunk:
+                    await send({"type": "http.response.body", "body": b""})
+                while chunk:
+                    following = await pool.run(next_chunk, chunks)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": bool(following)})
+                    chunk = following
+            finally:
+                if hasattr(response, "close"):
+                    response.close()
+        finally:
+            if release:
+                pool.release()
+
+    @staticmethod
+    async def _read_body(receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return body
+
+    @staticmethod
+    async def _error(send, status, message, headers=()):
+        body = json.dumps(message).encode("utf-8")
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + list(headers)})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                for pool in self.pools.values():
+                    pool.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+# WSGI environ of an ASGI HTTP request
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+        elif "HTTP_" + name in environ:
+            environ["HTTP_" + name] += "," + value
+        else:
+            environ["HTTP_" + name] = value
+    return environ
+
+# Call the WSGI app (in a pool thread). Returns the status, the headers, the first chunk of the
+# body, an iterator over the rest and the body iterable (to close once sent)
+def run_wsgi(app, environ):
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+
+    body = app(environ, start_response)
+    chunks = iter(body)
+    first = next_chunk(chunks)
+    status, headers = response # Set once the app has started returning its body
+    return status, headers, first, chunks, body
+
+# Next chunk of at least CHUNK_SIZE bytes of a body (shorter at the end, b"" when done)
+def next_chunk(chunks):
+    chunk = b""
+    for data in chunks:
+        chunk += data
+        if len(chunk) >= CHUNK_SIZE:
+            break
+    return chunk
+
+# Serve a WSGI app with uvicorn in ASGI mode (see AsgiServer for the other parameters)
+def serve(app, host, port, cpu_workers, io_workers, max_queue, timeout):
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError("ASGI serving mode requires uvicorn: `pip install uvicorn`")
+
+    uvicorn.run(AsgiServer(app, cpu_workers, io_workers, max_queue, timeout), host=host, port=port)
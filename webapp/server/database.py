@@ -9,16 +9,21 @@ from pathlib import Path
 # add directory of db_driver.py to path for importing
 db_driver_path = Path(__file__).resolve().parents[2] / "db_and_model"
 sys.path.insert(1, str(db_driver_path))
-from db_driver import DbDriver
+from db_driver import DbDriver, PAPER_FIELDS
 
 def get_db(uri, user, password, num_neighbours, lsi_dims, lda_dims, pdf_path,
            text_path, model_path, debug_info, train_model, build_nodes,
-           convert_pdfs):
+           convert_pdfs, search_mode="exact", nprobe=8,
+           batch_size=1000, writers=1, workers=None, layout_method="tsne",
+           cache_size=1024, cache_ttl=300, text_index="neo4j", incremental=False,
+           knn_backend="gds", knn_mode="exact", knn_recall=False, fast_start=False,
+           train_chunksize=None, lda_alpha="auto", pool_size=100, pool_timeout=60,
+           pool_lifetime=3600, warm_up=0, related_index="memory"):
     '''
-    Connect to neo4j database and builds if desired
+    Connect to database and builds if desired
 
     Parameters:
-        uri: [string] Database URI
+        uri: [string] Database URI, "bolt://<host>:<port>" (Neo4j), "embedded://<directory>" or "memory://"
         user: [string] Database account username
         password: [string] Database account password
         num_neighbours: [int] Number of connections for documents in graph database
@@ -27,26 +32,72 @@ def get_db(uri, user, password, num_neighbours, lsi_dims, lda_dims, pdf_path,
         pdf_path: [string] Path to top-level directory to recursively load PDF files from
         text_path: [string] Path to directory which stores all parsed PDF text files
         model_path: [string] Path to directory which stores saved model files
-        debug_info: [bool] Whether to turn on or off debug info for database
+        debug_info: [bool] Whether to print the duration of every database build and query call
         train_model: [bool] Whether to train new model or load existing
         build_nodes: [bool] Whether to create new database nodes or not
         convert_pdfs: [bool] Whether to convert PDFs to text files or load existing
+        search_mode: [string] Topic search index mode, "exact" or "approx"
+        nprobe: [int] Number of index lists scanned per topic query in "approx" mode
+        batch_size: [int] Number of papers written per database transaction when building nodes
+        writers: [int] Number of concurrent database writer sessions when building nodes
+        workers: [int] Number of workers for PDF conversion, LDA training and document projection (None for one per CPU core)
+        layout_method: [string] Method for the global 2D layout of the papers, "tsne" or "pca"
+        cache_size: [int] Maximum number of cached query results (0 to disable the cache)
+        cache_ttl: [float] Seconds before a cached query result expires
+        text_index: [string] Author/title search backend, "neo4j" (indexed properties) or "ngram" (in-process)
+        incremental: [bool] Only add new PDFs to the existing database (and update the LDA model online
+            with them if train_model) instead of rebuilding
+        knn_backend: [string] KNN graph builder, "gds" (gds.beta.knn in the database) or "native" (Python)
+        knn_mode: [string] "exact" or "approx" neighbours for the native KNN graph builder
+        knn_recall: [bool] Report the recall of the native KNN graph against the GDS result
+        fast_start: [bool] Memory-map the saved model and load each of its parts on first use instead of at startup
+        train_chunksize: [int] Number of documents per LSI/LDA training chunk (None for the gensim defaults)
+        lda_alpha: [string] LDA prior, "auto" (learned, trained in a single process), "symmetric" or "asymmetric"
+        pool_size: [int] Maximum number of Neo4j connections
+        pool_timeout: [float] Seconds a query waits for a free Neo4j connection before failing
+        pool_lifetime: [float] Seconds before a Neo4j connection is closed and replaced
+        warm_up: [int] Number of database connections opened before returning
+        related_index: [string] Related-paper queries answered from the KNN graph loaded in memory ("memory")
+            or by traversing it in the database ("db")
     Returns:
         db: DbDriver instance
     '''
     print("[INFO]: Connecting to database")
     db = DbDriver(uri, user, password, num_neighbours, lsi_dims, lda_dims, pdf_path,
-                  text_path, model_path, debug_info)
+                  text_path, model_path, debug_info, search_mode, nprobe,
+                  batch_size, writers, workers, layout_method, cache_size, cache_ttl,
+                  text_index, knn_backend, knn_mode, knn_recall, fast_start,
+                  train_chunksize, lda_alpha, pool_size, pool_timeout, pool_lifetime)
 
     # build the database with supplied arguments
 
-    if build_nodes:
-        db.destroy_db()
+    if incremental:
+        db.update_db(train_model, convert_pdfs)
+    else:
+        if build_nodes:
+            db.destroy_db()
 
-    db.build_db(train_model, build_nodes, convert_pdfs)
+        db.build_db(train_model, build_nodes, convert_pdfs)
 
-    if build_nodes:
-        db.build_knn_graph()
+        if build_nodes:
+            db.build_knn_graph()
+
+    # load paper coordinates into the in-process topic search index
+    db.build_vector_index()
+
+    # rank the papers of every topic for topic browsing
+    db.build_topic_index()
+
+    # load author names and titles into the in-process text index if selected
+    if text_index == "ngram":
+        db.build_text_index()
+
+    # load the KNN graph and paper properties in memory for related-paper queries if selected
+    if related_index == "memory":
+        db.build_neighbour_graph()
+
+    # open the connections the first requests will use
+    db.warm_up(warm_up)
 
     return db
 
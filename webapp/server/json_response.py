@@ -0,0 +1,135 @@
+'''
+JSON responses
+
+Bodies are encoded with orjson when it is installed (native encoder, serializes NumPy arrays
+without converting them to lists first), otherwise with the json module. They are compressed
+with brotli (if installed) or gzip when the client accepts it, and lists of many items are
+streamed: encoded, compressed and sent a block of items at a time, so the first bytes go out
+before the whole list is encoded.
+'''
+import json
+import time
+import zlib
+import numpy as np
+from flask import Response
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compression settings for responses generated per request: faster levels than the defaults,
+# for most of the size reduction at a fraction of the time (gzip level 1 is about 4 times as
+# fast as the default level 6 on search results, for 10% larger bodies)
+GZIP_LEVEL = 1
+BROTLI_QUALITY = 4
+
+# Number of items of a streamed list encoded and sent at once
+STREAM_BLOCK = 256
+
+# Values the encoders do not serialize natively (NumPy arrays and scalars with the json module)
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+# JSON encoding of obj as bytes
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, separators=(",", ":")).encode("utf-8")
+
+# Content encoding to use for a request with the given Accept-Encoding header: "br" (if brotli
+# is installed), "gzip" or None, following the q-values of the header
+def accepted_encoding(header):
+    weights = {}
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    for encoding in (["br"] if brotli is not None else []) + ["gzip"]:
+        if weights.get(encoding, weights.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+class Compressor:
+    '''
+
+    Streaming brotli or gzip compressor. compress() returns the compressed data of a block
+    flushed so that the client can decode it right away, finish() the end of the stream
+
+    '''
+    def __init__(self, encoding):
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.process = self.compressor.process
+            self.flush = self.compressor.flush
+            self.finish = self.compressor.finish
+        else:
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) # 31: gzip container
+            self.process = self.compressor.compress
+            self.flush = lambda: self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = self.compressor.flush
+
+    def compress(self, data):
+        return self.process(data) + self.flush()
+
+# JSON response for res. The body is compressed when it has at least compress_min_size bytes and
+# the client accepts a supported encoding, and a list of at least stream_min_items items is
+# streamed. Encoding is timed as the json_serialization stage, compression as the compression stage
+def json_response(res, accept_encoding="", compress_min_size=1024, stream_min_items=1000):
+    encoding = accepted_encoding(accept_encoding)
+
+    if isinstance(res, list) and len(res) >= max(stream_min_items, 1):
+        response = Response(_stream(res, encoding), mimetype="application/json")
+    else:
+        with metrics.timed("stage", "json_serialization"):
+            body = dumps(res)
+        if encoding is not None and len(body) >= compress_min_size:
+            with metrics.timed("stage", "compression"):
+                compressor = Compressor(encoding)
+                body = compressor.process(body) + compressor.finish()
+        else:
+            encoding = None
+        response = Response(body, mimetype="application/json")
+
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+# Body of a streamed list: "[", the encoded items a block at a time, "]". The time spent
+# encoding and compressing all blocks is recorded once the stream ends
+def _stream(items, encoding):
+    compressor = Compressor(encoding) if encoding is not None else None
+    t_tot = 0.0
+    for start in range(0, len(items), STREAM_BLOCK):
+        t_init = time.perf_counter()
+        block = b"[" if start == 0 else b","
+        block += b",".join(dumps(item) for item in items[start:start + STREAM_BLOCK])
+        if start + STREAM_BLOCK >= len(items):
+            block += b"]"
+        if compressor is not None:
+            block = compressor.compress(block)
+        t_tot += time.perf_counter() - t_init
+        yield block
+
+    if compressor is not None:
+        yield compressor.finish()
+    metrics.observe("stage", "json_serialization", t_tot)